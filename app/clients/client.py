@@ -1,5 +1,5 @@
 import asyncio, json
-from typing import Optional
+from typing import Optional, AsyncIterator
 from contextlib import AsyncExitStack
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
@@ -62,6 +62,10 @@ class MCPClient:
     ### Answer the user query -------------------------------------------------------------------------------
     async def process_query(self, query: str) -> str:
         """Process a query using Claude and available tools"""
+        return ''.join([chunk async for chunk in self.process_query_stream(query)])
+
+    async def process_query_stream(self, query: str) -> AsyncIterator[str]:
+        """Same as process_query, yields the final answer as the model generates it"""
         response = await self.session.list_tools()
         available_tools = [{
             "name": tool.name,
@@ -69,10 +73,9 @@ class MCPClient:
             "input_schema": tool.inputSchema
         } for tool in response.tools]
         
-        final_text = []
         return_format = """{"tool_name": "selected toolname","arguments":{"name arg1":value,"name arg2":value}} """
         tool_prompt = settings.decision_prompt + f' User prompt: {query}; tool list: {available_tools}; return JSON format template: {return_format}'
-        initial_response = oci_llm.answer_prompt(tool_prompt)
+        initial_response = await oci_llm.answer_prompt_async(tool_prompt)
 
         try:
             metadata = json.loads(initial_response)
@@ -80,10 +83,10 @@ class MCPClient:
             metadata = None
         
         if not metadata:
-            final_text.append(initial_response)
-            return "\n".join(final_text)
+            yield initial_response
+            return
         
-        final_text.append(f"[Try calling tool {metadata}]")
+        yield f"[Try calling tool {metadata}]\n"
 
         tool_name = metadata['tool_name']
         tool_args = metadata['arguments']
@@ -94,17 +97,15 @@ class MCPClient:
             #result = await self.session.read_resource("file://claude_files") TODO: fix
             result = await self.session.call_tool(tool_name,tool_args)
         except Exception as e:
-            result = f'Failed to use tool: {e}'
-            final_text.append(result)
+            yield f'Failed to use tool: {e}'
+            return
 
         tool_response = []
         for content in result.content:
             tool_response.append(content.text)
 
-        final_response = oci_llm.answer_prompt(f'{query}. Answer using the information from: {tool_response}')
-        final_text.append(final_response)
-
-        return "\n".join(final_text)
+        async for delta in oci_llm.answer_prompt_stream(f'{query}. Answer using the information from: {tool_response}'):
+            yield delta
     
     ### Chat interface --------------------------------------------------------
     async def chat_loop(self):
@@ -119,8 +120,10 @@ class MCPClient:
                 if query.lower() == 'quit':
                     break
 
-                response = await self.process_query(query)
-                print("\nMODEL RESPONSE: " + response)
+                print("\nMODEL RESPONSE: ", end='', flush=True)
+                async for chunk in self.process_query_stream(query):
+                    print(chunk, end='', flush=True)
+                print()
 
             except Exception as e:
                 print(f"\nError: {str(e)}")
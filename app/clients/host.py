@@ -1,8 +1,8 @@
-from mcp import ClientSession, StdioServerParameters
+from mcp import ClientSession, StdioServerParameters, types
 from mcp.client.stdio import stdio_client
 from contextlib import AsyncExitStack
-from typing import Dict,Any
-import asyncio, json, logging
+from typing import Dict,Any,AsyncIterator
+import asyncio, json, logging, time, re, ast
 from dotenv import load_dotenv
 from src.servers.modules.config import Settings
 from src.servers.modules.oci_client import Client
@@ -10,6 +10,117 @@ from src.servers.modules.oci_client import Client
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(name=f'HOST.{__name__}')
 
+TOOLS_TTL = 600 # seconds before a server tool list is fetched again
+CONNECT_TIMEOUT = 60 # seconds to wait for a server to start and initialize
+TOOL_TIMEOUT = 120 # seconds for each tool call of a plan
+RETURN_FORMAT = """[{"server": "name of the server the tool is from","tool_name": "selected toolname","arguments":{"name arg1":value,"name arg2":value}}] """
+JSON_TYPES = {"string": str, "integer": int, "number": (int, float), "boolean": bool, "array": list, "object": dict}
+
+def _scan_json(text:str) -> tuple[int | None, list[str]]:
+    """Index after the first JSON value and the brackets still open, None while the value is not closed"""
+    closers = []
+    quote = None
+    escaped = False
+    for idx, char in enumerate(text):
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in ('"', "'"):
+            quote = char
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+        elif char in '}]' and closers:
+            closers.pop()
+            if not closers:
+                return idx + 1, closers
+    return None, closers
+
+def _balanced_json(text:str) -> str:
+    """Cuts the text at the end of the first JSON value, closing brackets the model left open"""
+    end, closers = _scan_json(text)
+    if end is not None:
+        return text[:end]
+    return text.rstrip().rstrip(',') + ''.join(reversed(closers))
+
+def _plan_start(text:str) -> int:
+    """Where a tool plan could begin: the first bracket or fence, or trailing backticks that may become one"""
+    starts = [idx for idx in (text.find('{'), text.find('['), text.find('```')) if idx != -1]
+    ticks = len(text) - len(text.rstrip('`'))
+    if ticks:
+        starts.append(len(text) - ticks)
+    return min(starts) if starts else len(text)
+
+def _plan_end(text:str) -> int | None:
+    """End of the bracket or fenced block text starts with, None while it is still open"""
+    if text.startswith('```'):
+        end = text.find('```', 3)
+        return end + 3 if end != -1 else None
+    if text and text[0] in '{[':
+        return _scan_json(text)[0]
+    return None # backticks only, wait for the next delta
+
+def _load_json(candidate:str) -> Any:
+    try:
+        return json.loads(candidate)
+    except RecursionError:
+        return None
+    except ValueError:
+        python_like = re.sub(r"\btrue\b", "True", candidate)
+        python_like = re.sub(r"\bfalse\b", "False", python_like)
+        python_like = re.sub(r"\bnull\b", "None", python_like)
+        try:
+            return ast.literal_eval(python_like)
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            return None
+
+def parse_tool_calls(text:str) -> list[dict[str,Any]] | None:
+    """Local tolerant parser for the tool plan returned by the LLM, a list of tool requests or a single one.
+    Handles markdown fences, text around the JSON, single quotes and missing closing brackets"""
+    if not text:
+        return None
+    fenced = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", text, re.S)
+    if fenced and '{' in fenced.group(1):
+        text = fenced.group(1)
+    starts = sorted(idx for idx in (text.find('['), text.find('{')) if idx != -1)
+
+    for start in starts:
+        metadata = _load_json(_balanced_json(text[start:]))
+        if isinstance(metadata, dict):
+            metadata = [metadata]
+        if not isinstance(metadata, list):
+            continue
+        calls = [call for call in metadata if isinstance(call, dict) and 'tool_name' in call]
+        if not calls:
+            continue
+        for call in calls:
+            if not isinstance(call.get('arguments'), dict):
+                call['arguments'] = {}
+        return calls
+    return None
+
+def validate_tool_call(metadata:dict[str,Any], tool:dict[str,Any] | None) -> str | None:
+    """Checks the arguments against the tool inputSchema, returns the error found or None"""
+    if tool is None:
+        return f"Tool {metadata.get('tool_name')} not found in server {metadata.get('server')}"
+    schema = tool.get("input_schema") or {}
+    properties = schema.get("properties", {})
+    args = metadata['arguments']
+    for name in schema.get("required", []):
+        if name not in args:
+            return f'Missing required argument: {name}'
+    for name in list(args.keys()):
+        if name not in properties:
+            args.pop(name)
+            continue
+        expected = JSON_TYPES.get(properties[name].get("type"))
+        if expected and args[name] is not None and not isinstance(args[name], expected):
+            return f'Argument {name} should be {properties[name].get("type")}'
+    return None
+
 class MCP_ConnectionManager:
     _instance = None
     _initializaed = None
@@ -22,29 +133,94 @@ class MCP_ConnectionManager:
     def __init__(self):
         if not MCP_ConnectionManager._initializaed:
             self.connections: Dict[str,ClientSession] = {}
-            self.async_stacks: Dict[str,AsyncExitStack] = {}
-            self.exit_stack = AsyncExitStack()
+            # Each server lives in its own task so its stdio context is opened and closed by the same task
+            self.server_tasks: Dict[str,asyncio.Task] = {}
+            self.shutdown_events: Dict[str,asyncio.Event] = {}
+            # Tool catalog cache, filled at connect time and refreshed on list_changed or TTL
+            self.tool_catalog: Dict[str,list[Any]] = {}
+            self.catalog_ts: Dict[str,float] = {}
+            self.catalog_version = 0
+            self._prompt_version = -1
+            self._tools_prompt = ''
             MCP_ConnectionManager._initializaed = True
 
-    async def connectToServer(self, id:str, command:str, server_args:list[str]) -> ClientSession:
+    def _notification_handler(self, id:str):
+        async def handler(message) -> None:
+            if isinstance(message, types.ServerNotification) and isinstance(message.root, types.ToolListChangedNotification):
+                logger.debug(f'tool list changed on server: {id}')
+                self.invalidate_tools(id)
+        return handler
+
+    async def _server_lifetime(self, id:str, server_params:StdioServerParameters, ready:asyncio.Future, shutdown:asyncio.Event):
+        try:
+            async with AsyncExitStack() as stack:
+                read, write = await stack.enter_async_context(stdio_client(server_params))
+                session = await stack.enter_async_context(
+                    ClientSession(read, write, message_handler=self._notification_handler(id)))
+                await session.initialize()
+                self.connections[id] = session
+                ready.set_result(session)
+                await shutdown.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                logger.info(f'Server {id} closed with error: {e}')
+        finally:
+            self.connections.pop(id, None)
+            self.invalidate_tools(id) # its tools are no longer offered to the model
+
+    async def connectToServer(self, id:str, command:str, server_args:list[str], timeout:float = CONNECT_TIMEOUT) -> ClientSession:
         server_params = StdioServerParameters(
             command=command,
             args=server_args,
             env=None
         )
-        
-        stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        self.stdio, self.write = stdio_transport
-        session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
-        await session.initialize()
 
-        self.connections[id] = session
-        self.async_stacks[id] = self.exit_stack
+        ready = asyncio.get_running_loop().create_future()
+        shutdown = asyncio.Event()
+        task = asyncio.create_task(self._server_lifetime(id, server_params, ready, shutdown))
+        try:
+            session = await asyncio.wait_for(asyncio.shield(ready), timeout)
+        except BaseException:
+            shutdown.set()
+            task.cancel()
+            raise
+
+        self.server_tasks[id] = task
+        self.shutdown_events[id] = shutdown
+        try:
+            await self._refresh_tools(id)
+        except Exception as e:
+            logger.debug(f'Failed to list tools from {id}: {e}')
 
         logger.info(f"connected to server: {id}")
+        return session
+
+    async def connect_all(self, configs:Dict[str,Dict[str,Any]], timeout:float = CONNECT_TIMEOUT) -> Dict[str,str]:
+        """Starts every server from a server.json style config concurrently.
+        Returns the servers that failed to connect with the error found"""
+        ids = list(configs.keys())
+        results = await asyncio.gather(*[
+            self.connectToServer(id, configs[id]["command"], configs[id]["args"], configs[id].get("timeout", timeout))
+            for id in ids
+        ], return_exceptions=True)
+
+        failed = {}
+        for id, result in zip(ids, results):
+            if isinstance(result, BaseException):
+                failed[id] = str(result) or type(result).__name__
+                logger.info(f'Failed to connect to server {id}: {failed[id]}')
+        return failed
     
     def get_client(self, id:str) -> ClientSession | None:
         return self.connections[id]
+
+    def get_tool(self, server:str, tool_name:str) -> dict[str,Any] | None:
+        for tool in self.tool_catalog.get(server, []):
+            if tool["name"] == tool_name:
+                return tool
+        return None
     
     def get_all_clients(self) -> list[ClientSession]:
         keys = self.connections.keys()
@@ -53,31 +229,63 @@ class MCP_ConnectionManager:
             clients.append(self.connections[key])
         return clients
 
-    async def get_all_tools(self) -> list[Any]:
-        keys = self.connections.keys()
-        all_tools = []
+    async def _refresh_tools(self, id:str) -> list[Any]:
+        tool_list = await self.connections[id].list_tools()
+        server_tools = [{
+            "name": tool.name,
+            "description": tool.description,
+            "input_schema": tool.inputSchema
+        }for tool in tool_list.tools]
+        self.tool_catalog[id] = server_tools
+        self.catalog_ts[id] = time.monotonic()
+        self.catalog_version += 1
+        return server_tools
+
+    def _is_stale(self, id:str) -> bool:
+        if id not in self.tool_catalog:
+            return True
+        return time.monotonic() - self.catalog_ts.get(id, 0) > TOOLS_TTL
+
+    def invalidate_tools(self, id:str|None = None):
+        """Drops the cached tools of a server (or all of them) so the next read lists them again"""
+        keys = [id] if id else list(self.tool_catalog.keys())
         for key in keys:
-            try:
-                tool_list = await self.connections[key].list_tools()
-                server_tools = [{
-                    "name": tool.name,
-                    "description": tool.description,
-                    "input_schema": tool.inputSchema
-                }for tool in tool_list.tools]
-                all_tools.append({"server":key,"tools":server_tools})
-            except Exception as e:
-                all_tools.append({"server":key,"tools":[e]})
-        return all_tools
-    
+            self.tool_catalog.pop(key, None)
+            self.catalog_ts.pop(key, None)
+        self.catalog_version += 1
+
+    async def _get_server_tools(self, id:str) -> dict[str,Any]:
+        try:
+            if self._is_stale(id):
+                await self._refresh_tools(id)
+            return {"server":id,"tools":self.tool_catalog[id]}
+        except Exception as e:
+            return {"server":id,"tools":[e]}
+
+    async def get_all_tools(self) -> list[Any]:
+        keys = list(self.connections.keys())
+        return list(await asyncio.gather(*[self._get_server_tools(key) for key in keys]))
+
+    async def get_tools_prompt(self) -> str:
+        """Returns the tool catalog already serialized for the LLM prompt"""
+        all_tools = await self.get_all_tools()
+        if self._prompt_version != self.catalog_version:
+            self._tools_prompt = str(all_tools)
+            self._prompt_version = self.catalog_version
+        return self._tools_prompt
+
+    async def _disconnect_client(self, id:str):
+        self.shutdown_events.pop(id).set()
+        task = self.server_tasks.pop(id)
+        try:
+            await asyncio.wait_for(task, CONNECT_TIMEOUT)
+            logger.info(f'Disconnected from client: {id}')
+        except Exception as e:
+            logger.info(f'Failed to disconnect from {id} due to error: {e}')
+
     async def disconnect_all_clients(self):
-        keys = self.connections.keys()
-        for key in keys:
-            client = self.async_stacks[key]
-            try:
-                await client.aclose()
-                logger.info(f'Disconnected from client: {key}')
-            except Exception as e:
-                logger.info(f'Failed to disconnect from {key} due to error: {e}')
+        keys = list(self.server_tasks.keys())
+        await asyncio.gather(*[self._disconnect_client(key) for key in keys])
 
 class MCP_HostManager:
     def __init__(self):
@@ -88,49 +296,88 @@ class MCP_HostManager:
 
     async def process_query(self, query: str) -> str:
         """Process a query using Claude and available tools"""
-        response = await self.servers.get_all_tools()
+        return ''.join([chunk async for chunk in self.process_query_stream(query)])
+
+    async def process_query_stream(self, query: str) -> AsyncIterator[str]:
+        """Same as process_query, yields the answer text as the model generates it"""
+        response = await self.servers.get_tools_prompt()
         #logger.debug(response)
-        final_text = []
-        return_format = """{"server": "name of the server the tool is from","tool_name": "selected toolname","arguments":{"name arg1":value,"name arg2":value}} """
-        tool_prompt = self.settings.decision_prompt + f' User prompt: {query}; tool list: {response}; return JSON format template: {return_format}'
-        initial_response = self.oci_llm.answer_prompt(tool_prompt)
+        tool_prompt = self.settings.decision_prompt + f' User prompt: {query}; tool list: {response}; return JSON format template: {RETURN_FORMAT}'
 
-        try:
-            temp_llm = Client(self.settings)
-            prompt = f'Analyse the following text: {initial_response}. If the text is similar to a JSON format but incomplete or with errors, fix the sintax from the format accoring to the template: {return_format}. Do not add extra fields or information. If the format is correct, do not modify and return the same format just as given. If the text is not similar to a JSON format, rather a natural response, just return the same text.'
-            temp_json = temp_llm.answer_prompt(prompt)
-            logger.debug(temp_json)
-            metadata = json.loads(temp_json)
-        except Exception as e:
-            metadata = None
-        
-        if not metadata:
-            final_text.append(initial_response)
-            return "\n".join(final_text)
-        
-        final_text.append(f"[Try calling tool {metadata}]")
+        # Prose is streamed as it arrives, text is held back only from an open bracket or fence on,
+        # until it closes and the parser tells whether it is the tool plan.
+        # The history keeps the user's query, not the tool catalog
+        text = ''
+        sent = 0
+        tool_calls = None
+        async for delta in self.oci_llm.answer_prompt_stream(tool_prompt, memory_prompt=query):
+            text += delta
+            while tool_calls is None:
+                pending = text[sent:]
+                start = _plan_start(pending)
+                if start:
+                    yield pending[:start]
+                    sent += start
+                    pending = pending[start:]
+                end = _plan_end(pending) if pending else None
+                if end is None:
+                    break
+                tool_calls = parse_tool_calls(pending[:end])
+                if tool_calls is None:
+                    yield pending[:end]
+                    sent += end
 
-        tool_server = metadata['server']
-        tool_name = metadata['tool_name']
-        tool_args = metadata['arguments']
-        current_server = self.servers.get_client(tool_server)
+        held = text[sent:]
+        if tool_calls is None and held:
+            # The stream ended inside a bracket or fence, the parser closes what the model left open
+            tool_calls = parse_tool_calls(held)
+            if tool_calls is None and '{' in held:
+                # Only ask the LLM to fix the format when the local parser could not
+                prompt = f'Analyse the following text: {held}. If the text is similar to a JSON format but incomplete or with errors, fix the sintax from the format accoring to the template: {RETURN_FORMAT}. Do not add extra fields or information. If the format is correct, do not modify and return the same format just as given. If the text is not similar to a JSON format, rather a natural response, just return the same text.'
+                temp_json = await self.oci_llm.answer_prompt_async(prompt, stateless=True, temperature=0)
+                logger.debug(temp_json)
+                tool_calls = parse_tool_calls(temp_json)
+            if not tool_calls:
+                yield held
 
-        try:
-            response = await current_server.call_tool(tool_name,tool_args)
-        except Exception as e:
-            response = f'Failed to use tool: {e}'
-            final_text.append(response)
+        if not tool_calls:
+            return
 
-        logger.debug(f'tool response: {response}')
+        valid_calls = []
+        for metadata in tool_calls:
+            error = validate_tool_call(metadata, self.servers.get_tool(metadata.get('server'), metadata['tool_name']))
+            if error:
+                yield f"[Invalid tool call {metadata}: {error}]\n"
+            else:
+                valid_calls.append(metadata)
+        if not valid_calls:
+            return
+        
+        yield f"[Try calling tools {valid_calls}]\n"
 
-        tool_response = []
-        for content in response.content:
-            tool_response.append(content.text)
+        # Independent tool calls run together, the plan takes as long as the slowest one
+        results = await asyncio.gather(*[self._call_tool(metadata) for metadata in valid_calls])
+        tool_response = [
+            {"server": metadata['server'], "tool_name": metadata['tool_name'], "response": result}
+            for metadata, result in zip(valid_calls, results)
+        ]
+        logger.debug(f'tool response: {tool_response}')
 
-        final_response = self.oci_llm.answer_prompt(f'{query}. Answer the query. Here is some context information: {tool_response}',"Answer in less than 300 words. Address as much as possible the best answer for the user in the given context")
-        final_text.append(final_response)
+        async for delta in self.oci_llm.answer_prompt_stream(
+                f'{query}. Answer the query. Here is some context information: {tool_response}',
+                "Answer in less than 300 words. Address as much as possible the best answer for the user in the given context",
+                memory_prompt=query):
+            yield delta
 
-        return "\n".join(final_text)
+    async def _call_tool(self, metadata:dict[str,Any]) -> list[str] | str:
+        try:
+            # Inside the try so a disconnected server only fails its own call, not the whole plan
+            current_server = self.servers.get_client(metadata['server'])
+            response = await asyncio.wait_for(
+                current_server.call_tool(metadata['tool_name'], metadata['arguments']), TOOL_TIMEOUT)
+        except Exception as e:
+            return f'Failed to use tool: {str(e) or type(e).__name__}'
+        return [content.text for content in response.content if hasattr(content, 'text')]
     
     ### Chat interface --------------------------------------------------------
     async def chat_loop(self):
@@ -145,8 +392,10 @@ class MCP_HostManager:
                 if query.lower() == 'quit':
                     break
 
-                response = await self.process_query(query)
-                print("\nMODEL RESPONSE: " + response)
+                print("\nMODEL RESPONSE: ", end='', flush=True)
+                async for chunk in self.process_query_stream(query):
+                    print(chunk, end='', flush=True)
+                print()
 
             except Exception as e:
                 print(f"\nError: {str(e)}")
@@ -154,11 +403,16 @@ class MCP_HostManager:
 async def main():
     mcp_client_manger = MCP_ConnectionManager()
     host = MCP_HostManager()
+    servers = {
+        "slack": {"command": "python", "args": ["C:/Users/Cristopher Hdz/Desktop/Test/mcp_step/app/src/servers/slack_server.py"]},
+        "wl_db": {"command": "python", "args": ["C:/Users/Cristopher Hdz/Desktop/Test/mcp_step/app/src/servers/wl_server.py"]},
+        "file_system": {"command": "python", "args": ["C:/Users/Cristopher Hdz/Desktop/Test/mcp_step/app/src/servers/filesys_server.py"]},
+        "weather": {"command": "python", "args": ["C:/Users/Cristopher Hdz/Desktop/Test/mcp_step/app/src/servers/weather.py"]},
+    }
     try:
-        await mcp_client_manger.connectToServer("slack","python",["C:/Users/Cristopher Hdz/Desktop/Test/mcp_step/app/src/servers/slack_server.py"])
-        await mcp_client_manger.connectToServer("wl_db","python",["C:/Users/Cristopher Hdz/Desktop/Test/mcp_step/app/src/servers/wl_server.py"])
-        await mcp_client_manger.connectToServer("file_system","python",["C:/Users/Cristopher Hdz/Desktop/Test/mcp_step/app/src/servers/filesys_server.py"])
-        await mcp_client_manger.connectToServer("weather","python",["C:/Users/Cristopher Hdz/Desktop/Test/mcp_step/app/src/servers/weather.py"])
+        failed = await mcp_client_manger.connect_all(servers)
+        for id, error in failed.items():
+            print(f'Server {id} not available: {error}')
         await host.chat_loop()
     finally:
         await mcp_client_manger.disconnect_all_clients()
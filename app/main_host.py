@@ -6,6 +6,7 @@ from langchain_mcp_adapters.client import MultiServerMCPClient
 from langgraph.checkpoint.memory import InMemorySaver
 from langgraph.prebuilt import create_react_agent
 from langgraph.errors import GraphRecursionError
+from typing import AsyncIterator
 import json, asyncio, logging
 
 logging.basicConfig(level=logging.DEBUG)
@@ -88,6 +89,19 @@ class LangAgent:
 
         return final_text
     
+    async def process_query_stream(self,query) -> AsyncIterator[str]:
+        """Yields the agent text tokens as the model generates them"""
+        try:
+            async for message, metadata in self.agent.astream(
+                {"messages":query},
+                {"recursion_limit":self.recursion_limit,"configurable":{"thread_id":"1"}},
+                stream_mode="messages"
+            ):
+                if metadata.get("langgraph_node") == "agent" and isinstance(message.content, str) and message.content:
+                    yield message.content
+        except GraphRecursionError as g:
+            yield f"\nAgent stopped for recursion error/limit: {g}"
+    
     def thread_history(self):
         _config = {
             "configurable": {
@@ -105,8 +119,10 @@ async def main():
             break
 
         try:
-            response = await lang_agent.process_query(query)
-            print(f"\nModel response:\n{response}")
+            print("\nModel response:")
+            async for chunk in lang_agent.process_query_stream(query):
+                print(chunk, end='', flush=True)
+            print()
         except Exception as e:
             print(f"\nError in response:\n{e}")
     lang_agent.thread_history()
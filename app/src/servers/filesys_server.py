@@ -1,9 +1,27 @@
 from mcp.server.fastmcp import FastMCP
-from typing import Any
-import os
+from typing import Any, Iterator
+from contextlib import contextmanager
+from datetime import datetime
+import os, mmap
 
 mcp = FastMCP("file system")
 
+MAX_READ_BYTES = 256 * 1024 # largest payload returned by one read, bigger files are read by ranges
+MAX_LINES = 2000 # lines returned by one read_file_lines call
+
+@contextmanager
+def map_file(path:str) -> Iterator[mmap.mmap | bytes]:
+    """Read only memory map of the file, pages are loaded only when touched"""
+    with open(path,'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0: # empty files can not be mapped
+            yield b''
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+def decode(data:bytes) -> str:
+    return data.decode('utf-8', errors='replace')
+
 @mcp.resource("file://claude")
 def find_file()->list[Any]:
     path = r"C:\Users\Cristopher Hdz\Desktop\claude_files"
@@ -16,11 +34,81 @@ def find_file(name:str)->list[Any]:
 
 @mcp.tool()
 def open_file(path:str)->str:
-    """Reads the content of a file given a path by the user"""
+    """Reads the content of a file given a path by the user.
+    Files bigger than the read limit must be read with read_file_range or read_file_lines"""
+    size = os.path.getsize(path)
+    if size > MAX_READ_BYTES:
+        return (f'File too large to open at once ({size} bytes, limit {MAX_READ_BYTES}). '
+                'Use read_file_range or read_file_lines to read it by parts')
     with open(path,'r') as file:
         content = file.read()
         return f'File content:\n{content}'
     
+@mcp.tool()
+def read_file_range(path:str, offset:int = 0, length:int = MAX_READ_BYTES)->str:
+    """Reads length bytes of a file starting at offset (at most 256 KB per call).
+    The answer says the next offset to keep reading"""
+    if offset < 0 or length < 1:
+        return f'Invalid range: offset must be 0 or more and length at least 1 (got offset {offset}, length {length})'
+    length = min(length, MAX_READ_BYTES)
+    with map_file(path) as mapped:
+        size = len(mapped)
+        if offset >= size:
+            return f'Offset {offset} is past the end of the file ({size} bytes)'
+        end = min(offset + length, size)
+        content = decode(mapped[offset:end])
+    next_part = f', next offset {end}' if end < size else ', end of file'
+    return f'Bytes {offset}-{end} of {size}{next_part}:\n{content}'
+
+@mcp.tool()
+def read_file_lines(path:str, start_line:int = 1, count:int = 200)->str:
+    """Reads count lines of a file starting at start_line (1 based, at most 2000 lines or 256 KB per call).
+    The answer says the next line to keep reading"""
+    if start_line < 1 or count < 1:
+        return f'Invalid range: start_line and count must be at least 1 (got start_line {start_line}, count {count})'
+    count = min(count, MAX_LINES)
+    with map_file(path) as mapped:
+        size = len(mapped)
+        start = 0
+        for _ in range(start_line - 1):
+            newline = mapped.find(b'\n', start)
+            if newline == -1:
+                start = size
+                break
+            start = newline + 1
+        if start >= size:
+            return f'Line {start_line} is past the end of the file'
+        end = start
+        lines = 0
+        while lines < count and end < size and end - start < MAX_READ_BYTES:
+            newline = mapped.find(b'\n', end, start + MAX_READ_BYTES)
+            end = newline + 1 if newline != -1 else min(size, start + MAX_READ_BYTES)
+            lines += 1
+        mapped_cut = lines > 0 and end < size and mapped[end-1:end] != b'\n'
+        content = decode(mapped[start:end])
+    last_line = start_line + lines - 1
+    if end >= size:
+        next_part = ', end of file'
+    elif mapped_cut:
+        next_part = f', line {last_line} cut at the read limit, continue with read_file_range at offset {end}'
+    else:
+        next_part = f', next line {last_line + 1}'
+    return f'Lines {start_line}-{last_line}{next_part}:\n{content}'
+
+@mcp.tool()
+def file_stat(path:str)->dict[str,Any]:
+    """Size and dates of a file or directory, use it to decide how to read a file"""
+    info = os.stat(path)
+    return {
+        'path': os.path.abspath(path),
+        'is_file': os.path.isfile(path),
+        'is_dir': os.path.isdir(path),
+        'size': info.st_size,
+        'modified': datetime.fromtimestamp(info.st_mtime).isoformat(),
+        'created': datetime.fromtimestamp(info.st_ctime).isoformat(),
+        'fits_open_file': info.st_size <= MAX_READ_BYTES,
+    }
+
 @mcp.tool()
 def write_file(path:str, content:str)->str:
     """Writes content into a file path, could be provided or default, current directory"""
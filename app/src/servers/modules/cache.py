@@ -0,0 +1,95 @@
+import sqlite3, hashlib, json, logging, threading, time
+from collections import OrderedDict
+from typing import Any
+
+logger = logging.getLogger(name=f'File.{__name__}----------->')
+
+def normalize(text:str) -> str:
+    return ' '.join(str(text or '').split())
+
+def make_key(*parts:Any) -> str:
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """Two tier (memory LRU + SQLite) cache for LLM responses with TTL and size based eviction"""
+    def __init__(self, path:str = '', memory_entries:int = 256, max_entries:int = 5000, ttl:int = 86400):
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory: OrderedDict[str,tuple[float,Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.metrics = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0}
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    created REAL)""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses(created)")
+            self._db.commit()
+
+    def _expired(self, created:float) -> bool:
+        return bool(self.ttl) and time.time() - created > self.ttl
+
+    def get(self, key:str) -> Any | None:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and not self._expired(entry[0]):
+                self._memory.move_to_end(key)
+                self.metrics['memory_hits'] += 1
+                return entry[1]
+            self._memory.pop(key, None)
+
+            if self._db:
+                row = self._db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row and not self._expired(row[1]):
+                    value = json.loads(row[0])
+                    self._remember(key, row[1], value)
+                    self.metrics['disk_hits'] += 1
+                    return value
+            self.metrics['misses'] += 1
+            return None
+
+    def _remember(self, key:str, created:float, value:Any):
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def set(self, key:str, value:Any):
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, value)
+            self.metrics['stores'] += 1
+            if not self._db:
+                return
+            try:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, value, created) VALUES (?,?,?)",
+                                 (key, json.dumps(value), created))
+                if self.metrics['stores'] % 100 == 0:
+                    self._evict()
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.debug(e)
+
+    def _evict(self):
+        if self.ttl:
+            self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        self._db.execute("""
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> dict[str,Any]:
+        lookups = self.metrics['memory_hits'] + self.metrics['disk_hits'] + self.metrics['misses']
+        hits = lookups - self.metrics['misses']
+        return {**self.metrics, 'hit_rate': round(hits / lookups, 3) if lookups else 0}
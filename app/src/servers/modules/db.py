@@ -1,8 +1,64 @@
-import oracledb,json,logging
+import oracledb,json,logging,re,sys,hashlib
+from typing import Any, Callable, Iterable, Iterator
 from .config import Settings
 
 logger = logging.getLogger(name='DB details')
 
+STMT_CACHE_SIZE = 40 # statements kept parsed per pooled connection
+FETCH_ARRAYSIZE = 200 # rows per fetch round trip
+CONTENT_BATCH = 50 # ids per content lookup, short batches are padded so the statement text never changes
+INGEST_BATCH = 500 # rows per executemany and commit while ingesting
+COLUMN_PATTERN = re.compile(r"t\.[\w\.\[\]]+") # projected columns are part of the SQL text, only table paths allowed
+
+# Relational projection of the metadata JSON so the filters run as index range scans
+PROJECTION_DDL = [
+    """ALTER TABLE WL_Calls ADD report_date DATE
+        GENERATED ALWAYS AS (json_value(metadata, '$.report_date' RETURNING DATE NULL ON ERROR)) VIRTUAL""",
+    """ALTER TABLE WL_Calls ADD report_type VARCHAR2(32)
+        GENERATED ALWAYS AS (json_value(metadata, '$.type' RETURNING VARCHAR2(32) NULL ON ERROR)) VIRTUAL""",
+    """ALTER TABLE WL_Calls ADD customer VARCHAR2(400)
+        GENERATED ALWAYS AS (json_value(metadata, '$.customer' RETURNING VARCHAR2(400) NULL ON ERROR)) VIRTUAL""",
+    "CREATE INDEX wl_calls_date_idx ON WL_Calls (report_date)",
+    "CREATE INDEX wl_calls_type_idx ON WL_Calls (report_type, report_date)",
+    "CREATE INDEX wl_calls_customer_idx ON WL_Calls (customer)",
+    "CREATE INDEX wl_calls_created_idx ON WL_Calls (creation_ts)",
+    # regions and products are arrays, a multivalue index covers every element
+    "CREATE MULTIVALUE INDEX wl_calls_region_mvi ON WL_Calls t (t.metadata.regions.region.string())",
+    "CREATE MULTIVALUE INDEX wl_calls_product_mvi ON WL_Calls t (t.metadata.products.product.string())",
+]
+# Content digest used by the upsert ingestion to skip files that did not change
+INGEST_DDL = [
+    "ALTER TABLE WL_Calls ADD content_hash VARCHAR2(64)",
+    "ALTER TABLE WL_Calls ADD updated_ts TIMESTAMP WITH TIME ZONE",
+    "CREATE INDEX wl_calls_file_idx ON WL_Calls (file_name)",
+    "CREATE INDEX wl_calls_updated_idx ON WL_Calls (updated_ts)",
+]
+HASH_BACKFILL = "UPDATE WL_Calls SET content_hash = LOWER(RAWTOHEX(STANDARD_HASH(content, 'SHA256'))) WHERE content_hash IS NULL AND content IS NOT NULL"
+INSERT_QUERY = "INSERT INTO WL_Calls (file_name,metadata,content,content_hash) VALUES(:1,:2,:3,:4)"
+UPDATE_QUERY = "UPDATE WL_Calls SET metadata = :1, content = :2, content_hash = :3, updated_ts = SYSTIMESTAMP WHERE id = :4"
+EXISTS_ERRORS = (955, 1430, 1408) # name already used, column already added, columns already indexed
+MIGRATED_COLUMNS = ('REPORT_DATE', 'REPORT_TYPE', 'CUSTOMER', 'CONTENT_HASH', 'UPDATED_TS') # added by migrate
+
+# One aggregate per statement, so each MAX is an index min/max lookup and COUNT a primary key index scan
+VERSION_QUERIES = (
+    "SELECT MAX(creation_ts) FROM WL_Calls",
+    "SELECT COUNT(*) FROM WL_Calls",
+    "SELECT MAX(updated_ts) FROM WL_Calls",
+)
+
+# Distinct filter values with the number of call reports for each
+FACET_QUERIES = {
+    'years': "SELECT EXTRACT(YEAR FROM report_date) AS year, COUNT(*) FROM WL_Calls WHERE report_date IS NOT NULL GROUP BY EXTRACT(YEAR FROM report_date) ORDER BY year",
+    'types': "SELECT report_type, COUNT(*) FROM WL_Calls WHERE report_type IS NOT NULL GROUP BY report_type ORDER BY report_type",
+    'customers': "SELECT customer, COUNT(*) FROM WL_Calls WHERE customer IS NOT NULL GROUP BY customer ORDER BY customer",
+    'regions': """SELECT jt.region, COUNT(DISTINCT t.id) FROM WL_Calls t,
+        JSON_TABLE(t.metadata, '$.regions[*]' COLUMNS (region VARCHAR2(32) PATH '$.region')) jt
+        WHERE jt.region IS NOT NULL GROUP BY jt.region ORDER BY jt.region""",
+    'products': """SELECT jt.product, COUNT(DISTINCT t.id) FROM WL_Calls t,
+        JSON_TABLE(t.metadata, '$.products[*]' COLUMNS (product VARCHAR2(400) PATH '$.product')) jt
+        WHERE jt.product IS NOT NULL GROUP BY jt.product ORDER BY jt.product""",
+}
+
 class DataBase:
     def __init__(self, settings: Settings):
         self._settings = settings
@@ -19,58 +75,203 @@ class DataBase:
             min=2,
             max=10,
             increment=1,
+            stmtcachesize=db_params.get('stmt_cache_size') or STMT_CACHE_SIZE,
         )
     
         self.main_data = []
+        self._seen: set[tuple[str,str]] = set() # (file_name, content digest) already collected
         logger.info('---------- DB Pool created ----------')
 
     def _get_connection(self):
         logger.info('Connected to DB')
         return self._pool.acquire()
     
-    def build_query(self,cols=['t.id','t.metadata.file_name'],year=2010,type='',region='',customer='',product='') -> str:
+    def build_query(self,cols=['t.id','t.metadata.file_name'],year=2010,type='',region='',customer='',product='') -> tuple[str,dict]:
+        """Returns the SQL and its bind values. Filter values are never part of the text,
+        so each combination of filters maps to one statement reused from the statement cache"""
+        for col in cols:
+            if not COLUMN_PATTERN.fullmatch(col):
+                raise ValueError(f'Invalid column: {col}')
         search = ','.join(cols)
-        query = rf"""SELECT {search} FROM WL_Calls t WHERE json_query(metadata, '$.report_date.date()?(@ > "{str(year)}-01-01T00:00")') IS NOT NULL"""
+        query = rf"""SELECT {search} FROM WL_Calls t WHERE t.report_date > TO_DATE(:since, 'YYYY-MM-DD')"""
+        binds = {'since': f'{year or 2010}-01-01'}
         if type:
-            query = query + rf""" AND json_query(metadata, '$?(@.type == "{str(type)}")') IS NOT NULL"""
+            query = query + r""" AND t.report_type = :type"""
+            binds['type'] = str(type)
         if region:
-            query = query + rf""" AND json_query(metadata, '$?(@.regions.region == "{str(region)}")') IS NOT NULL"""
+            query = query + r""" AND json_exists(metadata, '$.regions.region?(@ == $region)' PASSING :region AS "region")"""
+            binds['region'] = str(region)
         if customer:
-            query = query + rf""" AND json_query(metadata, '$?(@.customer == "{str(customer)}")') IS NOT NULL"""
+            query = query + r""" AND t.customer = :customer"""
+            binds['customer'] = str(customer)
         if product:
-            query = query + rf""" AND json_query(metadata, '$?(@.products.product starts with ("{str(product[0])}"))') IS NOT NULL"""
-        return query
+            # Prefix as a range so the multivalue index can be used
+            prefix = str(product[0] if isinstance(product, (list, tuple)) else product)
+            query = query + r""" AND json_exists(metadata, '$.products.product?(@ >= $low && @ < $high)' PASSING :low AS "low", :high AS "high")"""
+            binds['low'] = prefix
+            binds['high'] = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return query, binds
     
-    def collect_data(self,name,data,content):
+    def _prepare(self, name, data, content) -> tuple | None:
         try:
             metadata = json.dumps(data)
-            file_data = (name,metadata,content)
-            if file_data in self.main_data:
-                pass
-            else:
-                self.main_data.append(file_data)
         except Exception as e:
             logger.debug(e)
+            return None
+        digest = hashlib.sha256((content or '').encode('utf-8')).hexdigest()
+        return (name, metadata, content, digest)
+
+    def collect_data(self,name,data,content):
+        file_data = self._prepare(name,data,content)
+        if file_data and (name, file_data[3]) not in self._seen:
+            self._seen.add((name, file_data[3]))
+            self.main_data.append(file_data)
+
+    def update_db_records(self, on_commit:Callable[[list[int]],Any] | None = None, upsert:bool = False, batch_size:int = INGEST_BATCH) -> dict[str,int]:
+        """Writes the collected files, see ingest"""
+        stats = self._write(self.main_data, on_commit, upsert, batch_size)
+        self.main_data = []
+        self._seen = set()
+        return stats
 
-    def update_db_records(self):
+    def ingest(self, records:Iterable[tuple[str,Any,str]], on_commit:Callable[[list[int]],Any] | None = None, upsert:bool = False, batch_size:int = INGEST_BATCH) -> dict[str,int]:
+        """Streams (file_name, metadata, content) records into WL_Calls in batches of batch_size, each batch committed on its own.
+        With upsert files already stored are updated only when their content changed, otherwise every record is inserted.
+        on_commit gets the ids of the updated rows once everything is written, used to index the new content"""
+        prepared = (self._prepare(*record) for record in records)
+        return self._write((record for record in prepared if record), on_commit, upsert, batch_size)
+
+    def _execute_batch(self, connection, query:str, rows:list[tuple]) -> set[int]:
+        """Runs and commits one batch, returns the offsets of the rows that failed"""
+        cursor = connection.cursor()
+        cursor.executemany(query, rows, batcherrors=True)
+        errors = cursor.getbatcherrors()
+        for error in errors:
+            logger.debug(f'Row {rows[error.offset][0]} failed: {error.message}')
+        connection.commit()
+        return {error.offset for error in errors}
+
+    def _write(self, records:Iterable[tuple], on_commit, upsert:bool, batch_size:int) -> dict[str,int]:
+        stats = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'duplicated': 0, 'failed': 0}
+        seen = set()
+        inserts, updates, updated_ids = [], [], []
         with self._get_connection() as connection:
-            cursor = connection.cursor()
-            try:
-                query = "INSERT INTO WL_Calls (file_name,metadata,content) VALUES(:1,:2,:3)"
-                cursor.executemany(query,self.main_data)
-                connection.commit()
-                logger.info('rows inserted')
-            except Exception as e:
-                logger.debug(e)
-
-    def sort_files(self,query:str):
+            existing = {}
+            if upsert:
+                cursor = connection.cursor()
+                cursor.arraysize = FETCH_ARRAYSIZE
+                existing = {name: (id, digest) for id, name, digest in cursor.execute(
+                    "SELECT id, file_name, content_hash FROM WL_Calls")}
+
+            def flush_inserts():
+                failed = self._execute_batch(connection, INSERT_QUERY, inserts)
+                stats['inserted'] += len(inserts) - len(failed)
+                stats['failed'] += len(failed)
+                inserts.clear()
+
+            def flush_updates():
+                failed = self._execute_batch(connection, UPDATE_QUERY, updates)
+                updated_ids.extend(row[3] for offset, row in enumerate(updates) if offset not in failed)
+                stats['updated'] += len(updates) - len(failed)
+                stats['failed'] += len(failed)
+                updates.clear()
+
+            for name, metadata, content, digest in records:
+                if (name, digest) in seen:
+                    stats['duplicated'] += 1
+                    continue
+                seen.add((name, digest))
+                if name in existing:
+                    id, stored_digest = existing[name]
+                    if stored_digest == digest:
+                        stats['unchanged'] += 1
+                        continue
+                    updates.append((metadata, content, digest, id))
+                    if len(updates) >= batch_size:
+                        flush_updates()
+                else:
+                    inserts.append((name, metadata, content, digest))
+                    if len(inserts) >= batch_size:
+                        flush_inserts()
+            if inserts:
+                flush_inserts()
+            if updates:
+                flush_updates()
+        logger.info(f'Ingestion finished: {stats}')
+        if on_commit and (stats['inserted'] or stats['updated']):
+            on_commit(updated_ids)
+        return stats
+
+    def sort_files(self,query:str,binds:dict|list|None = None):
         db_responses = []
+        for rows in self.iter_batches(query, binds):
+            db_responses.extend(rows)
+        return db_responses
+
+    def iter_batches(self, query:str, binds:dict|list|None = None, arraysize:int = FETCH_ARRAYSIZE, prefetchrows:int|None = None) -> Iterator[list[tuple]]:
+        """Yields the result in batches of arraysize rows, only one batch is held in memory at a time"""
         with self._get_connection() as connection:
             cursor = connection.cursor()
-            rows = cursor.execute(query)
+            cursor.arraysize = arraysize
+            # First batch comes back with the execute round trip
+            cursor.prefetchrows = prefetchrows if prefetchrows is not None else arraysize + 1
+            cursor.execute(query, binds or {})
+            while rows := cursor.fetchmany():
+                yield rows
+
+    def fetch_columns(self, query:str, binds:dict|list|None = None, arraysize:int = FETCH_ARRAYSIZE) -> list[list[Any]]:
+        """Columnar result, one list per projected column filled while fetching (no transpose copy)"""
+        columns = []
+        for rows in self.iter_batches(query, binds, arraysize):
+            if not columns:
+                columns = [[] for _ in rows[0]]
             for row in rows:
-                db_responses.append(row)
-        return db_responses
+                for column, value in zip(columns, row):
+                    column.append(value)
+        return columns
+
+    def fetch_content(self, ids:list[int]) -> list[str]:
+        """Content of the given call reports, in the same order as ids"""
+        content = self.content_by_id(ids)
+        return [content[id] for id in ids if id in content]
+
+    def content_by_id(self, ids:list[int]) -> dict[int,str]:
+        placeholders = ','.join(f':{idx+1}' for idx in range(CONTENT_BATCH))
+        query = f"SELECT t.id, t.content FROM WL_Calls t WHERE t.id IN ({placeholders})"
+        content = {}
+        for start in range(0, len(ids), CONTENT_BATCH):
+            batch = list(ids[start:start+CONTENT_BATCH])
+            batch += [batch[-1]] * (CONTENT_BATCH - len(batch))
+            for rows in self.iter_batches(query, batch):
+                content.update(rows)
+        return content
+
+    def iter_content(self, after_id:int = 0, arraysize:int = FETCH_ARRAYSIZE) -> Iterator[list[tuple]]:
+        """(id, content) of the rows added after after_id, in id order"""
+        query = "SELECT t.id, t.content FROM WL_Calls t WHERE t.id > :after_id ORDER BY t.id"
+        yield from self.iter_batches(query, {'after_id': after_id}, arraysize)
+
+    def data_version(self) -> tuple[Any,int,Any]:
+        """Latest creation_ts, row count and latest updated_ts, changes whenever rows are added, removed or updated"""
+        with self._get_connection() as connection:
+            cursor = connection.cursor()
+            return tuple(cursor.execute(query).fetchone()[0] for query in VERSION_QUERIES)
+
+    def updated_since(self, since=None) -> list[int]:
+        """Ids of the rows updated in place after since (an updated_ts from data_version), all updated rows if None"""
+        if since is None:
+            rows = self.sort_files("SELECT t.id FROM WL_Calls t WHERE t.updated_ts IS NOT NULL")
+        else:
+            rows = self.sort_files("SELECT t.id FROM WL_Calls t WHERE t.updated_ts > :since", {'since': since})
+        return [row[0] for row in rows]
+
+    def get_facets(self) -> dict[str,list[list[Any]]]:
+        facets = {}
+        with self._get_connection() as connection:
+            cursor = connection.cursor()
+            for name, query in FACET_QUERIES.items():
+                facets[name] = [[value, count] for value, count in cursor.execute(query)]
+        return facets
 
     def init(self):
         with self._get_connection() as connection:
@@ -96,11 +297,36 @@ class DataBase:
 
             connection.commit()
             logger.info('Table created with name: WL_Calls')
+        self.migrate()
+
+    def missing_columns(self) -> list[str]:
+        """Columns added by migrate that WL_Calls does not have yet"""
+        rows = self.sort_files("SELECT column_name FROM user_tab_columns WHERE table_name = 'WL_CALLS'")
+        present = {row[0] for row in rows}
+        return [column for column in MIGRATED_COLUMNS if column not in present]
+
+    def migrate(self):
+        """Adds the virtual columns and indexes to an existing WL_Calls table, safe to run more than once"""
+        with self._get_connection() as connection:
+            cursor = connection.cursor()
+            for ddl in PROJECTION_DDL + INGEST_DDL:
+                try:
+                    cursor.execute(ddl)
+                except oracledb.DatabaseError as e:
+                    error, = e.args
+                    if error.code not in EXISTS_ERRORS:
+                        raise
+            cursor.execute(HASH_BACKFILL)
+            connection.commit()
+            logger.info('WL_Calls metadata projection ready')
 
+# Run as a module from app/src/servers (relative imports): python -m modules.db [--migrate]
 def main():
     settings = Settings('mcp.yaml')
     db = DataBase(settings)
-    print(db.sort_files(r"""SELECT t.id,t.metadata.file_name FROM WL_Calls t WHERE json_query(metadata, '$.report_date.date()?(@ > "2018-01-01T00:00")') IS NOT NULL"""))
+    if '--migrate' in sys.argv:
+        db.migrate()
+    print(db.sort_files(*db.build_query(year=2018)))
 
 if __name__=='__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,83 @@
+import re
+from typing import Any
+
+# Local extraction of [year,type,region,customer,product] so most searches skip the LLM
+YEAR_PATTERN = re.compile(r'\b(19[5-9]\d|20\d{2})\b')
+REGION_PATTERN = re.compile(r'\b[A-Z]{2}\b')
+TYPE_PATTERNS = {
+    'no_bid': re.compile(r'\bno[\s_-]?bids?\b', re.IGNORECASE),
+    'win': re.compile(r'\b(wins?|won)\b', re.IGNORECASE),
+    'loss': re.compile(r'\b(loss|losses|lost)\b', re.IGNORECASE),
+}
+MIN_NAME_LEN = 3 # shorter customer/product names match inside too many words
+# Words that may name a customer or product the facets do not know, the LLM decides what they mean
+NAME_PATTERN = re.compile(r"\b[A-Z][\w&'-]*")
+NAME_AFTER_PATTERN = re.compile(r"\b(?:for|with)\s+([a-z][\w&'-]*)")
+COMMON_WORDS = {
+    'i', 'no', 'a', 'an', 'the', 'all', 'any', 'each', 'every', 'some', 'our', 'my', 'their', 'its', 'this', 'that',
+    'these', 'those', 'them', 'it', 'me', 'us', 'you', 'customer', 'customers', 'product', 'products', 'region',
+    'regions', 'deal', 'deals', 'report', 'reports', 'call', 'calls', 'document', 'documents', 'year', 'years',
+    'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november',
+    'december',
+}
+
+def _facet_values(facets:dict[str,Any] | None, name:str) -> list[str]:
+    return [str(value) for value, _ in (facets or {}).get(name, []) if value]
+
+def _find_names(query:str, names:list[str]) -> list[str]:
+    """Known names present in the query as whole words, longer names first so 'Acme Bank' wins over 'Acme'"""
+    found = []
+    lowered = query.lower()
+    for name in sorted(names, key=len, reverse=True):
+        if len(name) < MIN_NAME_LEN:
+            continue
+        if re.search(rf'(?<!\w){re.escape(name.lower())}(?!\w)', lowered):
+            if not any(name.lower() in other.lower() for other in found):
+                found.append(name)
+    return found
+
+def _unmatched_names(query:str, matched:list[str], regions:set[str]) -> list[str]:
+    """Capitalized words past the sentence start and words after 'for'/'with' that are not a known
+    customer, product, region or type"""
+    lowered = query.lower()
+    covered = [(match.start(), match.end()) for name in matched
+               for match in re.finditer(rf'(?<!\w){re.escape(name.lower())}(?!\w)', lowered)]
+    candidates = [match for match in NAME_PATTERN.finditer(query)
+                  if query[:match.start()].strip() and query[:match.start()].rstrip()[-1] not in '.!?']
+    candidates += NAME_AFTER_PATTERN.finditer(query)
+    unmatched = []
+    for match in candidates:
+        word = match.group(match.lastindex or 0)
+        start = match.start(match.lastindex or 0)
+        if word.lower() in COMMON_WORDS or word in regions or any(pattern.fullmatch(word) for pattern in TYPE_PATTERNS.values()):
+            continue
+        if any(begin <= start < end for begin, end in covered):
+            continue
+        unmatched.append(word)
+    return unmatched
+
+def extract_filter(query:str, facets:dict[str,Any] | None) -> tuple[list, bool]:
+    """Returns the filter list and True when the query needs the LLM:
+    more than one customer, product or region named, a name the facets do not know, or nothing recognized at all"""
+    years = sorted({int(year) for year in YEAR_PATTERN.findall(query)})
+    year = years[0] if years else None # the query filters from that year on
+
+    types = [type for type, pattern in TYPE_PATTERNS.items() if pattern.search(query)]
+    if 'no_bid' in types:
+        types = ['no_bid']
+    type = types[0] if len(types) == 1 else None # win and loss together means both
+    known_types = {value.lower(): value for value in _facet_values(facets, 'types')}
+    if type and known_types:
+        type = known_types.get(type.lower(), type)
+
+    known_regions = set(_facet_values(facets, 'regions'))
+    regions = sorted({region for region in REGION_PATTERN.findall(query) if region in known_regions})
+    customers = _find_names(query, _facet_values(facets, 'customers'))
+    products = _find_names(query, _facet_values(facets, 'products'))
+
+    ambiguous = len(regions) > 1 or len(customers) > 1 or len(products) > 1
+    ambiguous = ambiguous or bool(_unmatched_names(query, customers + products, known_regions))
+    found = [year, type, regions[0] if regions else None, customers[0] if customers else None, products[0] if products else None]
+    if query.strip() and not any(found) and not types:
+        ambiguous = True
+    return found, ambiguous
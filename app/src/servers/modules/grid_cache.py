@@ -0,0 +1,51 @@
+import sqlite3, json, threading, time
+from typing import Any
+
+POINT_DECIMALS = 4 # NWS resolves points to 4 decimals (about 11 m), more precision maps to the same grid
+
+class GridCache:
+    """SQLite cache from rounded lat/lon to the NWS points properties (forecast URLs and gridpoint).
+    Points NWS does not cover are stored as misses with a shorter TTL"""
+    def __init__(self, path:str = 'nws_grid.db', ttl:int = 30 * 86400, negative_ttl:int = 86400):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS points (
+                    lat REAL,
+                    lon REAL,
+                    data TEXT, -- NULL for points outside the NWS coverage
+                    created REAL,
+                    PRIMARY KEY (lat, lon))""")
+            self._db.commit()
+
+    @staticmethod
+    def key(latitude:float, longitude:float) -> tuple[float,float]:
+        return round(latitude, POINT_DECIMALS), round(longitude, POINT_DECIMALS)
+
+    def get(self, latitude:float, longitude:float) -> tuple[bool, dict[str,Any] | None]:
+        """(found, data), data is None for a cached miss"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data, created FROM points WHERE lat = ? AND lon = ?",
+                self.key(latitude, longitude)).fetchone()
+        if not row:
+            return False, None
+        ttl = self.ttl if row[0] is not None else self.negative_ttl
+        if time.time() - row[1] > ttl:
+            return False, None
+        return True, json.loads(row[0]) if row[0] is not None else None
+
+    def set(self, latitude:float, longitude:float, data:dict[str,Any] | None):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO points (lat, lon, data, created) VALUES (?,?,?,?)",
+                (*self.key(latitude, longitude), json.dumps(data) if data is not None else None, time.time()))
+            self._db.commit()
+
+    def delete(self, latitude:float, longitude:float):
+        with self._lock:
+            self._db.execute("DELETE FROM points WHERE lat = ? AND lon = ?", self.key(latitude, longitude))
+            self._db.commit()
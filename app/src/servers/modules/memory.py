@@ -0,0 +1,104 @@
+import logging, threading
+from typing import Any, Callable
+from oci.generative_ai_inference import models
+
+logger = logging.getLogger(name=f'File.{__name__}----------->')
+
+DEFAULT_SESSION = 'default'
+CHARS_PER_TOKEN = 4 # rough estimate used only to weight turns when evicting
+
+def estimate_tokens(text:str) -> int:
+    return len(text or '') // CHARS_PER_TOKEN + 1
+
+class Session:
+    def __init__(self):
+        self.summary = ''
+        self.turns: list[tuple[str,str]] = [] # (user message, chatbot message)
+        self.tokens = 0 # estimated tokens of the summary and turns, the history's own size
+        self.trimming = False # a trim runs in the background, further ones are skipped meanwhile
+
+class ConversationMemory:
+    """Per-session chat history kept under a token budget.
+    Old turns are dropped (window) or folded into a running summary (summarize) on overflow"""
+    def __init__(self, token_budget:int = 4000, max_turns:int = 20, eviction:str = 'window',
+                 summarizer: Callable[[str], str] | None = None):
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.eviction = eviction
+        self.summarizer = summarizer
+        self.sessions: dict[str,Session] = {}
+        self._lock = threading.Lock()
+
+    def _get_session(self, session_id:str) -> Session:
+        if session_id not in self.sessions:
+            self.sessions[session_id] = Session()
+        return self.sessions[session_id]
+
+    def get_history(self, session_id:str = DEFAULT_SESSION) -> list[Any]:
+        """Builds the chat_history for the OCI request"""
+        with self._lock:
+            session = self._get_session(session_id)
+            history = []
+            if session.summary:
+                history.append(models.CohereSystemMessage(message=f'Summary of the previous conversation: {session.summary}'))
+            for user, bot in session.turns:
+                history.append(models.CohereUserMessage(message=user))
+                history.append(models.CohereChatBotMessage(message=bot))
+            return history
+
+    def record(self, session_id:str, user:str, bot:str):
+        """Only the turn itself counts against the budget, not the preamble or the rest of the request"""
+        with self._lock:
+            session = self._get_session(session_id)
+            session.turns.append((user, bot))
+            session.tokens += estimate_tokens(user) + estimate_tokens(bot)
+
+    def needs_trim(self, session_id:str = DEFAULT_SESSION) -> bool:
+        session = self.sessions.get(session_id)
+        if not session:
+            return False
+        # The latest turn is always kept, a single oversized turn is not a reason to trim
+        return len(session.turns) > 1 and (session.tokens > self.token_budget or len(session.turns) > self.max_turns)
+
+    def trim(self, session_id:str = DEFAULT_SESSION):
+        """Evicts the oldest turns until the session fits the budget again"""
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if not session or session.trimming:
+                return
+            evicted = []
+            tokens = session.tokens
+            while len(session.turns) > 1 and (tokens > self.token_budget or len(session.turns) > self.max_turns):
+                user, bot = session.turns.pop(0)
+                evicted.append((user, bot))
+                tokens -= estimate_tokens(user) + estimate_tokens(bot)
+            session.tokens = max(tokens, 0)
+            if not evicted:
+                return
+            session.trimming = True
+        logger.debug(f'Evicted {len(evicted)} turns from session {session_id}')
+
+        try:
+            if self.eviction == 'summarize' and self.summarizer:
+                old_text = '\n'.join(f'USER: {user}\nCHATBOT: {bot}' for user, bot in evicted)
+                try:
+                    summary = self.summarizer(f'{session.summary}\n{old_text}')
+                except Exception as e:
+                    logger.debug(e)
+                    # Put the turns back, they are evicted again on the next trim
+                    with self._lock:
+                        session.turns[:0] = evicted
+                        session.tokens += sum(estimate_tokens(user) + estimate_tokens(bot) for user, bot in evicted)
+                    return
+                with self._lock:
+                    session.tokens += estimate_tokens(summary) - estimate_tokens(session.summary)
+                    session.summary = summary
+        finally:
+            session.trimming = False
+
+    def reset(self, session_id:str|None = None):
+        with self._lock:
+            if session_id is None:
+                self.sessions = {}
+            else:
+                self.sessions.pop(session_id, None)
@@ -0,0 +1,98 @@
+import sqlite3, json, threading, time
+from typing import Any
+
+class MessageStore:
+    """Local SQLite copy of Slack channel histories keyed by (channel, ts).
+    Each channel keeps the contiguous window already downloaded (synced_from, synced_to)
+    so later reads only fetch messages newer than the high-water mark.
+    Edits and deletions of stored messages are not tracked"""
+    def __init__(self, path:str = 'slack_messages.db'):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    channel TEXT,
+                    ts TEXT,
+                    ts_num REAL,
+                    data TEXT,
+                    PRIMARY KEY (channel, ts));
+                CREATE INDEX IF NOT EXISTS messages_channel_ts ON messages(channel, ts_num);
+                CREATE TABLE IF NOT EXISTS channels (
+                    channel TEXT PRIMARY KEY,
+                    synced_from REAL,
+                    synced_to REAL);
+                CREATE TABLE IF NOT EXISTS threads (
+                    channel TEXT,
+                    thread_ts TEXT,
+                    latest_reply TEXT,
+                    data TEXT,
+                    saved_at REAL,
+                    PRIMARY KEY (channel, thread_ts));
+                CREATE TABLE IF NOT EXISTS day_summaries (
+                    channel TEXT,
+                    day TEXT,
+                    digest TEXT,
+                    summary TEXT,
+                    PRIMARY KEY (channel, day, digest));""")
+            try: # stores created before threads had saved_at
+                self._db.execute("ALTER TABLE threads ADD COLUMN saved_at REAL")
+            except sqlite3.OperationalError:
+                pass
+            self._db.commit()
+
+    def get_coverage(self, channel:str) -> tuple[float,float] | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT synced_from, synced_to FROM channels WHERE channel = ?", (channel,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def save(self, channel:str, messages:list[dict[str,Any]], synced_from:float, synced_to:float):
+        rows = [(channel, m['ts'], float(m['ts']), json.dumps(m)) for m in messages if 'ts' in m]
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO messages (channel, ts, ts_num, data) VALUES (?,?,?,?)", rows)
+            self._db.execute(
+                "INSERT OR REPLACE INTO channels (channel, synced_from, synced_to) VALUES (?,?,?)",
+                (channel, synced_from, synced_to))
+            self._db.commit()
+
+    def get_messages(self, channel:str, oldest:float, limit:int = 1000) -> list[dict[str,Any]]:
+        """Newest first, same order as conversations.history"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT data FROM messages WHERE channel = ? AND ts_num > ? ORDER BY ts_num DESC LIMIT ?",
+                (channel, oldest, limit)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_thread(self, channel:str, thread_ts:str, latest_reply:str, max_age:float) -> list[dict[str,Any]] | None:
+        """Stored replies of a thread, only if no reply was added after they were saved and they are newer than max_age seconds.
+        The age bound catches replies to parents that are served from the store with an old latest_reply"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM threads WHERE channel = ? AND thread_ts = ? AND latest_reply = ? AND saved_at > ?",
+                (channel, thread_ts, latest_reply, time.time() - max_age)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_thread(self, channel:str, thread_ts:str, latest_reply:str, replies:list[dict[str,Any]]):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO threads (channel, thread_ts, latest_reply, data, saved_at) VALUES (?,?,?,?,?)",
+                (channel, thread_ts, latest_reply, json.dumps(replies), time.time()))
+            self._db.commit()
+
+    def get_day_summary(self, channel:str, day:str, digest:str) -> str | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT summary FROM day_summaries WHERE channel = ? AND day = ? AND digest = ?",
+                (channel, day, digest)).fetchone()
+        return row[0] if row else None
+
+    def save_day_summary(self, channel:str, day:str, digest:str, summary:str):
+        """Keeps one summary per day, a new digest (messages changed) replaces the old one"""
+        with self._lock:
+            self._db.execute("DELETE FROM day_summaries WHERE channel = ? AND day = ?", (channel, day))
+            self._db.execute(
+                "INSERT INTO day_summaries (channel, day, digest, summary) VALUES (?,?,?,?)",
+                (channel, day, digest, summary))
+            self._db.commit()
@@ -1,13 +1,31 @@
-import oci,logging, ast
+import oci,logging, ast, asyncio, threading, json
+from typing import AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
 from oci.generative_ai_inference import GenerativeAiInferenceClient
 from oci.generative_ai_inference import models
 from .config import Settings
+from .memory import ConversationMemory, DEFAULT_SESSION, estimate_tokens
+from .cache import ResponseCache, make_key, normalize
 
 logger = logging.getLogger(name=f'File.{__name__}----------->')
 
 # General variables --------------------------
 PREAMBLE = 'Answer in maximum, 200 words'
-MESSAGE = ''
+SUMMARY_INSTRUCTIONS = 'answer in at least 6 bullet points and use just the information provided'
+MEMORY_INSTRUCTIONS = 'Summarize the conversation keeping names, figures and decisions. Use plain text'
+FETCH_ERROR = 'Error in fetching the message: '
+INTERNAL_ERROR = 'General internal error'
+LLM_WORKERS = 4 # max concurrent blocking OCI calls for the async methods
+FILTER_DEFAULT = [2010, None, None, None, None] # [year,type,region,customer,product] when the answer can not be parsed
+EMBED_MODEL = 'cohere.embed-multilingual-v3.0'
+EMBED_BATCH = 96 # max inputs per embed_text call
+
+# Shared by every Client so concurrent queries are bounded per process
+_executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix='oci_llm')
+
+def is_error(response:str) -> bool:
+    """True when the text is the error placeholder returned by a failed call, not a model answer"""
+    return response.startswith(FETCH_ERROR) or response == INTERNAL_ERROR
 
 class Client:
     def __init__(self, settings: Settings):
@@ -16,88 +34,268 @@ class Client:
             self.settings.oci_client.config_path, 
             self.settings.oci_client.configProfile)
         self.endpoint = self.settings.oci_client.endpoint
-        self.client = GenerativeAiInferenceClient(
+        self.client = self._build_client()
+        # One SDK client (and connection pool) per worker thread, reused between calls
+        self._local = threading.local()
+        self._local.client = self.client
+        
+        self.serving_mode = models.OnDemandServingMode(
+            model_id=self.settings.oci_client.model_id)
+        self.compartment_id = self.settings.oci_client.compartiment
+        self.embed_serving_mode = models.OnDemandServingMode(
+            model_id=self.settings.oci_client.embed_model_id or EMBED_MODEL)
+
+        memory = self.settings.memory or {}
+        self.memory = ConversationMemory(
+            token_budget=memory.get('token_budget', 4000),
+            max_turns=memory.get('max_turns', 20),
+            eviction=memory.get('eviction', 'window'),
+            summarizer=self._summarize_history)
+
+        cache = self.settings.llm_cache or {}
+        self.cache = None
+        self.cache_nondeterministic = cache.get('allow_nondeterministic', False)
+        if cache.get('enabled', False):
+            self.cache = ResponseCache(
+                path=cache.get('path', ''),
+                memory_entries=cache.get('memory_entries', 256),
+                max_entries=cache.get('max_entries', 5000),
+                ttl=cache.get('ttl', 86400))
+
+    def _build_client(self) -> GenerativeAiInferenceClient:
+        return GenerativeAiInferenceClient(
             config=self.config, 
             service_endpoint=self.endpoint, 
             retry_strategy=oci.retry.NoneRetryStrategy(), 
             timeout=(10,240))
+
+    def _get_client(self) -> GenerativeAiInferenceClient:
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._build_client()
+            self._local.client = client
+        return client
         
-        self.chat_detail = models.ChatDetails()
-        self.chat_detail.serving_mode = models.OnDemandServingMode(
-            model_id=self.settings.oci_client.model_id)
-        self.chat_detail.compartment_id = self.settings.oci_client.compartiment
-
-        self.message_db = {}
-        self.message_history = [] # user
-
-        self.chat_request = models.CohereChatRequest()
-        self.chat_request.preamble_override = PREAMBLE # user
-        self.chat_request.message = MESSAGE #user
-        self.chat_request.max_tokens = self.settings.oci_client.max_tokens
-        self.chat_request.temperature = self.settings.oci_client.temperature
-        self.chat_request.frequency_penalty = self.settings.oci_client.freq_penalty
-        self.chat_request.top_p = self.settings.oci_client.top_p
-        self.chat_request.top_k = self.settings.oci_client.top_k
-        self.chat_request.chat_history = self.message_history #user
-        
-    def _get_chat_details(self):
-        self.chat_detail.chat_request = self._get_chat_request()
+    # Chat parameters, built per call so concurrent requests do not share state
+    def _get_chat_details(self, prompt, instructions, history:list, temperature:float|None = None) -> models.ChatDetails:
+        chat_request = models.CohereChatRequest()
+        chat_request.preamble_override = PREAMBLE + instructions # user (keep 200 word limit)
+        chat_request.message = prompt #user
+        chat_request.max_tokens = self.settings.oci_client.max_tokens
+        chat_request.temperature = self.settings.oci_client.temperature if temperature is None else temperature
+        chat_request.frequency_penalty = self.settings.oci_client.freq_penalty
+        chat_request.top_p = self.settings.oci_client.top_p
+        chat_request.top_k = self.settings.oci_client.top_k
+        chat_request.chat_history = history #user
 
-        return self.chat_detail
-    
-    # Chat parameters
-    def _get_chat_request(self):
-        return self.chat_request
-    
-    def _set_chat_request(self, prompt, instructions):
-        self.chat_request.preamble_override = PREAMBLE + instructions # user (keep 200 word limit)
-        self.chat_request.message = prompt #user
-    
-    def _call_client(self,u_prompt, sys_instructions=''):
-        self.message_history.append(models.CohereUserMessage(message=u_prompt))
+        chat_detail = models.ChatDetails()
+        chat_detail.serving_mode = self.serving_mode
+        chat_detail.compartment_id = self.compartment_id
+        chat_detail.chat_request = chat_request
+        return chat_detail
+
+    def _cache_key(self, client_config:models.ChatDetails) -> str | None:
+        if self.cache is None:
+            return None
+        request = client_config.chat_request
+        # Sampled answers are only reused when explicitly allowed
+        if request.temperature and not self.cache_nondeterministic:
+            return None
+        history = [(m.role, normalize(m.message)) for m in request.chat_history or []]
+        return make_key(
+            normalize(request.message), normalize(request.preamble_override), history,
+            client_config.serving_mode.model_id, request.max_tokens, request.temperature,
+            request.frequency_penalty, request.top_p, request.top_k)
+
+    def _chat(self, client_config:models.ChatDetails) -> tuple[str,int|None]:
+        key = self._cache_key(client_config)
+        if key:
+            cached = self.cache.get(key)
+            if cached:
+                return cached[0], cached[1]
+
+        tokens = None
         try:
-            self._set_chat_request(u_prompt, sys_instructions)
-            client_config = self._get_chat_details()
-            chat_response = self.client.chat(client_config)
+            chat_response = self._get_client().chat(client_config)
             generated_response = chat_response.data.chat_response.text
             ## Use tokens from the model call
             tokens = chat_response.data.chat_response.usage.total_tokens
         except oci.exceptions.ServiceError as s:
             logger.debug(s)
-            generated_response = f'Error in fetching the message: {s.message}'
+            generated_response = f'{FETCH_ERROR}{s.message}'
+        except Exception as e:
+            logger.debug(e)
+            generated_response = INTERNAL_ERROR
+
+        if key and tokens is not None:
+            self.cache.set(key, [generated_response, tokens])
+        return generated_response, tokens
+
+    def _chat_stream(self, client_config:models.ChatDetails, on_delta:Callable[[str],None]) -> tuple[str,int|None]:
+        """Streamed chat call, on_delta gets every text delta as the model generates it"""
+        client_config.chat_request.is_stream = True
+        parts = []
+        tokens = None
+        try:
+            chat_response = self._get_client().chat(client_config)
+            for event in chat_response.data.events():
+                event_data = json.loads(event.data)
+                # The last event repeats the full text together with the finish reason
+                if 'finishReason' in event_data:
+                    usage = event_data.get('usage') or {}
+                    tokens = usage.get('totalTokens')
+                    break
+                delta = event_data.get('text', '')
+                if delta:
+                    parts.append(delta)
+                    on_delta(delta)
+            generated_response = ''.join(parts)
+            tokens = tokens or estimate_tokens(generated_response) + estimate_tokens(client_config.chat_request.message)
+        except oci.exceptions.ServiceError as s:
+            logger.debug(s)
+            generated_response = f'{FETCH_ERROR}{s.message}'
+            on_delta(generated_response)
         except Exception as e:
             logger.debug(e)
-            generated_response = 'General internal error'
-        self.message_history.append(models.CohereChatBotMessage(message=generated_response))
+            generated_response = INTERNAL_ERROR
+            on_delta(generated_response)
+        return generated_response, tokens
+
+    def _summarize_history(self, conversation:str) -> str:
+        summary, tokens = self._chat(self._get_chat_details(conversation, MEMORY_INSTRUCTIONS, []))
+        # Raising keeps the old turns, an error text must never become the summary
+        if tokens is None or is_error(summary):
+            raise RuntimeError(f'History summary failed: {summary}')
+        return summary
+    
+    # Stateless calls neither send nor store history.
+    # Extraction calls run at temperature 0 so their answers can be cached
+    # memory_prompt is recorded instead of the prompt when the prompt wraps the user's message in a long template.
+    # Trimming may summarize with another LLM call, it runs in the background so the answer is not held back
+    def _remember(self, session, prompt, response, memory_prompt=None):
+        self.memory.record(session, prompt if memory_prompt is None else memory_prompt, response)
+        if self.memory.needs_trim(session):
+            _executor.submit(self.memory.trim, session)
+
+    def _call_client(self,u_prompt, sys_instructions='', session=DEFAULT_SESSION, stateless=False, temperature=None, memory_prompt=None):
+        history = [] if stateless else self.memory.get_history(session)
+        generated_response, tokens = self._chat(self._get_chat_details(u_prompt, sys_instructions, history, temperature))
+        if not stateless and tokens is not None:
+            self._remember(session, u_prompt, generated_response, memory_prompt)
+        return generated_response
+
+    async def _call_client_async(self,u_prompt, sys_instructions='', session=DEFAULT_SESSION, stateless=False, temperature=None, memory_prompt=None):
+        history = [] if stateless else self.memory.get_history(session)
+        client_config = self._get_chat_details(u_prompt, sys_instructions, history, temperature)
+        loop = asyncio.get_running_loop()
+        generated_response, tokens = await loop.run_in_executor(_executor, self._chat, client_config)
+        if not stateless and tokens is not None:
+            self._remember(session, u_prompt, generated_response, memory_prompt)
         return generated_response
     
-    def provide_analysis(self, query:str, u_instructions:str = '') -> str:
+    def _analysis_request(self, query:str, u_instructions:str = '') -> tuple[str,str]:
         prompt = self.settings.analysis_prompt + query
         instructions = self.settings.analysis_instructions + u_instructions
-        response = self._call_client(prompt,instructions)
+        return prompt, instructions
+
+    def _parse_filter(self, response:str) -> list:
+        try:
+            r_dict = ast.literal_eval(response)
+        except Exception as e:
+            logger.debug(e)
+            return list(FILTER_DEFAULT)
+        if not isinstance(r_dict, (list, tuple)):
+            return list(FILTER_DEFAULT)
+        # Always 5 elements so the caller can unpack them
+        return (list(r_dict) + [None] * len(FILTER_DEFAULT))[:len(FILTER_DEFAULT)]
+
+    def provide_analysis(self, query:str, u_instructions:str = '', session=DEFAULT_SESSION, memory_prompt=None) -> str:
+        response = self._call_client(*self._analysis_request(query, u_instructions), session=session, memory_prompt=memory_prompt)
+        return response
+
+    async def provide_analysis_async(self, query:str, u_instructions:str = '', session=DEFAULT_SESSION, memory_prompt=None) -> str:
+        response = await self._call_client_async(*self._analysis_request(query, u_instructions), session=session, memory_prompt=memory_prompt)
         return response
 
     def filter_files(self, query:str) -> list:
         prompt = self.settings.filter_prompt + query
         instructions = self.settings.filter_instructions
-        response = self._call_client(prompt, instructions)
-        try:
-            r_dict = ast.literal_eval(response)
-        except Exception as e:
-            r_dict = [2010,None,None,None]
-        return r_dict
+        response = self._call_client(prompt, instructions, stateless=True, temperature=0)
+        return self._parse_filter(response)
+
+    async def filter_files_async(self, query:str) -> list:
+        prompt = self.settings.filter_prompt + query
+        instructions = self.settings.filter_instructions
+        response = await self._call_client_async(prompt, instructions, stateless=True, temperature=0)
+        return self._parse_filter(response)
     
     def summarize(self,query:str) -> str:
         prompt = query
-        response = self._call_client(prompt,'answer in at least 6 bullet points and use just the information provided')
+        response = self._call_client(prompt,SUMMARY_INSTRUCTIONS,stateless=True)
+        return response
+
+    async def summarize_async(self,query:str) -> str:
+        response = await self._call_client_async(query,SUMMARY_INSTRUCTIONS,stateless=True)
         return response
     
-    def answer_prompt(self, prompt, instructions='')->str:
-        response = self._call_client(prompt,instructions)
+    def answer_prompt(self, prompt, instructions='', session=DEFAULT_SESSION, stateless=False, temperature=None, memory_prompt=None)->str:
+        response = self._call_client(prompt,instructions,session,stateless,temperature,memory_prompt)
+        return response
+
+    async def answer_prompt_async(self, prompt, instructions='', session=DEFAULT_SESSION, stateless=False, temperature=None, memory_prompt=None)->str:
+        response = await self._call_client_async(prompt,instructions,session,stateless,temperature,memory_prompt)
         return response
     
-    def reset_chat(self):
-        self.message_history = []
+    async def answer_prompt_stream(self, prompt, instructions='', session=DEFAULT_SESSION, stateless=False, memory_prompt=None) -> AsyncIterator[str]:
+        """Same as answer_prompt_async but yields the text deltas as they arrive"""
+        history = [] if stateless else self.memory.get_history(session)
+        client_config = self._get_chat_details(prompt, instructions, history)
+        key = self._cache_key(client_config)
+        cached = self.cache.get(key) if key else None
+        if cached:
+            generated_response, tokens = cached
+            yield generated_response
+        else:
+            loop = asyncio.get_running_loop()
+            queue: asyncio.Queue[str|None] = asyncio.Queue()
+            future = loop.run_in_executor(
+                _executor, self._chat_stream, client_config,
+                lambda delta: loop.call_soon_threadsafe(queue.put_nowait, delta))
+            future.add_done_callback(lambda _: queue.put_nowait(None))
+            while (delta := await queue.get()) is not None:
+                yield delta
+            generated_response, tokens = await future
+            if key and tokens is not None:
+                self.cache.set(key, [generated_response, tokens])
+
+        if not stateless and tokens is not None:
+            self._remember(session, prompt, generated_response, memory_prompt)
+    
+    def embed(self, texts:list[str], input_type:str = 'SEARCH_DOCUMENT') -> list[list[float]]:
+        """One vector per text, empty list if the call fails"""
+        vectors = []
+        try:
+            for start in range(0, len(texts), EMBED_BATCH):
+                details = models.EmbedTextDetails(
+                    inputs=texts[start:start+EMBED_BATCH],
+                    serving_mode=self.embed_serving_mode,
+                    compartment_id=self.compartment_id,
+                    input_type=input_type,
+                    truncate='END')
+                vectors.extend(self._get_client().embed_text(details).data.embeddings)
+        except oci.exceptions.ServiceError as s:
+            logger.debug(s)
+            return []
+        except Exception as e:
+            logger.debug(e)
+            return []
+        return vectors
+
+    async def embed_async(self, texts:list[str], input_type:str = 'SEARCH_DOCUMENT') -> list[list[float]]:
+        return await asyncio.get_running_loop().run_in_executor(_executor, self.embed, texts, input_type)
+    
+    def reset_chat(self, session:str|None = None):
+        self.memory.reset(session)
 
 def main():
     settings = Settings("mcp.yaml")
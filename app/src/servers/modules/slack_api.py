@@ -0,0 +1,100 @@
+import asyncio, logging, time, aiohttp
+from typing import Any, AsyncIterator
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.errors import SlackApiError
+
+logger = logging.getLogger(name=f'File.{__name__}----------->')
+
+# Slack Web API tiers, requests per minute
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+METHOD_TIERS = {
+    'users.list': 2,
+    'users.info': 4,
+    'users.conversations': 3,
+    'conversations.list': 2,
+    'conversations.history': 3,
+    'conversations.replies': 3,
+}
+DEFAULT_TIER = 3
+MAX_RETRIES = 3
+
+class TokenBucket:
+    def __init__(self, per_minute:int):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, per_minute / 10)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.updated:
+                    # Paused by a Retry-After
+                    await asyncio.sleep(self.updated - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds:float):
+        # One request is allowed again as soon as the pause ends
+        self.tokens = 1
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+class RateLimiter:
+    """One token bucket per Web API method, sized by the method tier.
+    Share one instance between the clients of the same app, Slack counts the limits per app and workspace"""
+    def __init__(self, method_tiers:dict[str,int] = METHOD_TIERS):
+        self.method_tiers = method_tiers
+        self.buckets: dict[str,TokenBucket] = {}
+
+    def bucket(self, method:str) -> TokenBucket:
+        if method not in self.buckets:
+            tier = self.method_tiers.get(method, DEFAULT_TIER)
+            self.buckets[method] = TokenBucket(TIER_LIMITS[tier])
+        return self.buckets[method]
+
+class SlackAPI:
+    """Async Slack Web API access with per method rate limiting, Retry-After backoff and cursor pagination"""
+    def __init__(self, token:str, limiter:RateLimiter | None = None, max_retries:int = MAX_RETRIES):
+        self.client = AsyncWebClient(token=token)
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+
+    async def call(self, method:str, **kwargs) -> Any:
+        if self.client.session is None:
+            # Created inside the running loop and kept so every call reuses its connections
+            self.client.session = aiohttp.ClientSession()
+        bucket = self.limiter.bucket(method)
+        client_method = getattr(self.client, method.replace('.', '_'))
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            try:
+                return await client_method(**kwargs)
+            except SlackApiError as s:
+                if s.response.status_code != 429 or attempt == self.max_retries:
+                    raise
+                headers = s.response.headers or {}
+                retry_after = float(headers.get('Retry-After') or headers.get('retry-after') or 1)
+                logger.debug(f'{method} rate limited, retrying in {retry_after}s')
+                bucket.pause(retry_after)
+
+    async def paginate(self, method:str, key:str, max_items:int | None = None, **kwargs) -> AsyncIterator[Any]:
+        """Yields the items under key from every page of a cursor paginated method"""
+        cursor = None
+        count = 0
+        while True:
+            data = await self.call(method, cursor=cursor, **kwargs)
+            for item in data.get(key) or []:
+                yield item
+                count += 1
+                if max_items and count >= max_items:
+                    return
+            cursor = (data.get('response_metadata') or {}).get('next_cursor')
+            if not cursor:
+                return
@@ -0,0 +1,222 @@
+import sqlite3, logging, threading
+from typing import Callable, Iterable
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError: # optional, brute force search is used without it
+    hnswlib = None
+
+logger = logging.getLogger(name=f'File.{__name__}----------->')
+
+CHUNK_CHARS = 1500 # ~375 tokens, below the embedding model input limit
+CHUNK_OVERLAP = 200
+HNSW_MIN_CANDIDATES = 20000 # below this many candidate chunks the exact scan is already fast
+HNSW_SPACE = dict(M=16, ef_construction=200)
+
+def chunk_text(text:str, size:int = CHUNK_CHARS, overlap:int = CHUNK_OVERLAP) -> list[str]:
+    """Splits on paragraph or sentence boundaries when possible, windows overlap so no fact is cut in two"""
+    text = (text or '').strip()
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = max(text.rfind('\n', start + size // 2, end), text.rfind('. ', start + size // 2, end))
+            if cut > 0:
+                end = cut + 1
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return [chunk for chunk in chunks if chunk]
+
+class VectorIndex:
+    """Embeddings of document chunks kept in SQLite and searched in memory.
+    Vectors are normalized so the inner product is the cosine similarity.
+    Search is an exact NumPy scan over the allowed documents, an HNSW graph is added when hnswlib is installed
+    and used for searches with many candidate chunks"""
+    def __init__(self, path:str = 'wl_index.db'):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, -- never reused, ids are also the HNSW labels
+                    doc_id INTEGER,
+                    position INTEGER,
+                    text TEXT,
+                    vector BLOB,
+                    UNIQUE (doc_id, position));
+                CREATE INDEX IF NOT EXISTS chunks_doc ON chunks(doc_id);
+                CREATE TABLE IF NOT EXISTS state (
+                    key TEXT PRIMARY KEY, -- synced_id, last_updated
+                    value TEXT);""")
+            self._db.commit()
+        # (vectors, doc_ids, chunk_ids) replaced as one tuple so a search never sees arrays of different sizes
+        self._data = (np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        self._hnsw = None
+        self._load()
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._data[0]
+
+    @property
+    def doc_ids(self) -> np.ndarray:
+        return self._data[1]
+
+    @property
+    def chunk_ids(self) -> np.ndarray:
+        return self._data[2]
+
+    def _load(self):
+        with self._lock:
+            rows = self._db.execute("SELECT id, doc_id, vector FROM chunks ORDER BY id").fetchall()
+        if rows:
+            chunk_ids = np.array([row[0] for row in rows], dtype=np.int64)
+            doc_ids = np.array([row[1] for row in rows], dtype=np.int64)
+            vectors = np.vstack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+            self._data = (vectors, doc_ids, chunk_ids)
+            self._add_to_hnsw(vectors, chunk_ids)
+        logger.debug(f'{len(rows)} chunks loaded in the index')
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    def indexed(self, doc_ids:list[int]) -> set[int]:
+        """The doc_ids that have chunks in the index"""
+        all_doc_ids = self.doc_ids
+        return set(np.unique(all_doc_ids[np.isin(all_doc_ids, doc_ids)]).tolist())
+
+    def get_state(self, key:str) -> str | None:
+        """Sync progress kept next to the chunks so a restart resumes where the last sync stopped"""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key:str, value:str | None):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?,?)", (key, value))
+            self._db.commit()
+
+    @property
+    def synced_id(self) -> int:
+        """Every doc_id up to this one went through sync, new rows come after it"""
+        return int(self.get_state('synced_id') or 0)
+
+    def _add_to_hnsw(self, vectors:np.ndarray, labels:np.ndarray):
+        if hnswlib is None or not len(labels):
+            return
+        if self._hnsw is None:
+            self._hnsw = hnswlib.Index(space='ip', dim=vectors.shape[1])
+            self._hnsw.init_index(max_elements=max(len(labels) * 2, 1024), **HNSW_SPACE)
+        needed = self._hnsw.get_current_count() + len(labels)
+        if needed > self._hnsw.get_max_elements():
+            self._hnsw.resize_index(needed * 2)
+        self._hnsw.add_items(vectors, labels)
+
+    def add(self, documents:list[tuple[int,list[str],list[list[float]]]]):
+        """Adds (doc_id, chunks, vectors) documents with one commit and one append to the in-memory arrays"""
+        documents = [document for document in documents if document[1]]
+        if not documents:
+            return
+        matrix = np.asarray([vector for _, _, vectors in documents for vector in vectors], dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+        rows = [(doc_id, position, text) for doc_id, chunks, _ in documents for position, text in enumerate(chunks)]
+        with self._lock:
+            cursor = self._db.cursor()
+            ids = []
+            for (doc_id, position, text), vector in zip(rows, matrix):
+                cursor.execute(
+                    "INSERT INTO chunks (doc_id, position, text, vector) VALUES (?,?,?,?)",
+                    (doc_id, position, text, vector.tobytes()))
+                ids.append(cursor.lastrowid)
+            self._db.commit()
+        chunk_ids = np.array(ids, dtype=np.int64)
+        doc_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        vectors, old_doc_ids, old_chunk_ids = self._data
+        self._data = (
+            np.vstack([vectors, matrix]) if len(vectors) else matrix,
+            np.concatenate([old_doc_ids, doc_ids]),
+            np.concatenate([old_chunk_ids, chunk_ids]))
+        self._add_to_hnsw(matrix, chunk_ids)
+
+    def remove(self, doc_ids:list[int]):
+        """Drops the chunks of documents whose content changed, they are indexed again by sync"""
+        if not doc_ids or not len(self.doc_ids):
+            return
+        placeholders = ','.join('?' * len(doc_ids))
+        with self._lock:
+            self._db.execute(f"DELETE FROM chunks WHERE doc_id IN ({placeholders})", list(doc_ids))
+            self._db.commit()
+        vectors, old_doc_ids, chunk_ids = self._data
+        removed = np.isin(old_doc_ids, doc_ids)
+        if self._hnsw is not None:
+            for label in chunk_ids[removed].tolist():
+                self._hnsw.mark_deleted(label)
+        self._data = (vectors[~removed], old_doc_ids[~removed], chunk_ids[~removed])
+
+    def sync(self, rows:Iterable[list[tuple[int,str]]], embed:Callable[[list[str]],list[list[float]]],
+             new_rows:bool = False) -> bool:
+        """Indexes the (doc_id, content) rows given in batches, False if the embedding failed on the way.
+        With new_rows the batches are the rows after synced_id in id order, synced_id moves past each indexed batch
+        and documents already indexed are skipped"""
+        added = 0
+        for batch in rows:
+            if not batch:
+                continue
+            skip = self.indexed([doc_id for doc_id, _ in batch]) if new_rows else set()
+            pending = [(doc_id, chunk_text(content)) for doc_id, content in batch if doc_id not in skip]
+            texts = [chunk for _, chunks in pending for chunk in chunks]
+            if not texts:
+                if new_rows:
+                    self.set_state('synced_id', str(max(doc_id for doc_id, _ in batch)))
+                continue
+            vectors = embed(texts)
+            if len(vectors) != len(texts):
+                logger.debug(f'Embedding failed, index sync stopped after {added} documents')
+                return False
+            documents = []
+            offset = 0
+            for doc_id, chunks in pending:
+                documents.append((doc_id, chunks, vectors[offset:offset + len(chunks)]))
+                offset += len(chunks)
+            self.add(documents)
+            added += len(documents)
+            if new_rows:
+                self.set_state('synced_id', str(max(doc_id for doc_id, _ in batch)))
+        logger.debug(f'{added} documents indexed')
+        return True
+
+    def _texts(self, chunk_ids:list[int]) -> list[str]:
+        placeholders = ','.join('?' * len(chunk_ids))
+        with self._lock:
+            rows = dict(self._db.execute(
+                f"SELECT id, text FROM chunks WHERE id IN ({placeholders})", chunk_ids).fetchall())
+        return [rows[id] for id in chunk_ids if id in rows]
+
+    def search(self, query:list[float], k:int = 8, doc_ids:list[int] | None = None) -> list[str]:
+        """Top k chunk texts by similarity, only from doc_ids when given"""
+        vectors, all_doc_ids, chunk_ids = self._data
+        if not len(chunk_ids):
+            return []
+        q = np.asarray(query, dtype=np.float32)
+        q /= np.linalg.norm(q) + 1e-12
+        mask = np.isin(all_doc_ids, doc_ids) if doc_ids is not None else np.ones(len(all_doc_ids), dtype=bool)
+        candidates = int(mask.sum())
+        if not candidates:
+            return []
+        k = min(k, candidates)
+
+        if self._hnsw is not None and candidates >= HNSW_MIN_CANDIDATES:
+            allowed = set(chunk_ids[mask].tolist())
+            self._hnsw.set_ef(max(k * 4, 64))
+            labels, _ = self._hnsw.knn_query(q, k=k, filter=lambda label: label in allowed)
+            return self._texts([int(label) for label in labels[0]])
+
+        positions = np.flatnonzero(mask)
+        scores = vectors[positions] @ q
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return self._texts(chunk_ids[positions[top]].tolist())
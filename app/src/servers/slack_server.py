@@ -1,13 +1,24 @@
 from typing import Any
-from slack_sdk import WebClient
+import asyncio, time, hashlib, logging
 from modules.config import Settings
 from mcp.server.fastmcp import FastMCP
 from slack_sdk.errors import SlackApiError
 from datetime import datetime, timedelta
-from modules.oci_client import Client
+from modules.oci_client import Client, is_error
+from modules.memory import estimate_tokens
+from modules.slack_api import SlackAPI, RateLimiter
+from modules.message_store import MessageStore
 from dotenv import load_dotenv
 
 mcp = FastMCP("Slack")
+logger = logging.getLogger(name=f'Slack.{__name__}')
+
+USERS_TTL = 3600 # seconds before the user directory is swept again
+USERS_RETRY = 300 # seconds before a failed sweep is tried again, names are fetched one by one meanwhile
+MESSAGES_LIMIT = 1000 # max messages fetched per call and returned per channel
+CHUNK_TOKENS = 3000 # estimated tokens of conversation sent in each summary request
+SUMMARY_CONCURRENCY = 4 # chunk summaries requested at the same time
+THREAD_TTL = 900 # seconds a stored thread is served before its replies are read again
 
 class Storage:
     _instance = None
@@ -23,93 +34,284 @@ class Storage:
             load_dotenv()
             self.merged_data = ''
             self.settings = Settings("C:/Users/Cristopher Hdz/Desktop/Test/mcp_step/app/src/config/mcp.yaml")
-            self.slack_client = WebClient(token=self.settings.slack_app.bot_key)
-            self.slack_user = WebClient(token=self.settings.slack_app.user_lv_key)
+            limiter = RateLimiter() # bot and user tokens belong to the same app and share its limits
+            self.slack_client = SlackAPI(self.settings.slack_app.bot_key, limiter)
+            self.slack_user = SlackAPI(self.settings.slack_app.user_lv_key, limiter)
             self.llm_client = Client(self.settings)
+            self.users = UserDirectory(self.slack_client)
+            self.messages = MessageStore(self.settings.slack_app.get('store_path') or 'slack_messages.db')
             Storage._initialized = True
 
-def get_user_name(user_id:str = None) -> str:
+class UserDirectory:
+    """User id -> display name cache, filled with one paginated users_list sweep and refreshed on TTL"""
+    def __init__(self, slack_client:SlackAPI, ttl:int = USERS_TTL):
+        self.slack_client = slack_client
+        self.ttl = ttl
+        self.names: dict[str,str] = {}
+        self.loaded_at = 0.0 # 0 until the first successful sweep
+        self.failed_at: float | None = None
+        self.error: SlackApiError | None = None
+        self._lock = asyncio.Lock()
+        self._pending: dict[str,asyncio.Future] = {}
+
+    @staticmethod
+    def display_name(user:dict) -> str:
+        profile = user.get('profile', {})
+        return profile.get('display_name') or profile.get('real_name') or user['id']
+
+    async def refresh(self):
+        names = {}
+        async for user in self.slack_client.paginate('users.list', 'members', limit=200):
+            names[user['id']] = self.display_name(user)
+        self.names = names
+        self.loaded_at = time.monotonic()
+
+    async def _ensure_fresh(self):
+        """Sweeps when never loaded or expired. A failed sweep (missing scope, rate limited) is not retried
+        for USERS_RETRY seconds so each lookup does not pay a full paginated sweep"""
+        async with self._lock:
+            now = time.monotonic()
+            if self.loaded_at and now - self.loaded_at <= self.ttl:
+                return
+            if self.failed_at is not None and now - self.failed_at < USERS_RETRY:
+                return
+            try:
+                await self.refresh()
+                self.failed_at = None
+                self.error = None
+            except SlackApiError as s:
+                logger.debug(f'users.list sweep failed: {s}')
+                self.failed_at = now
+                self.error = s
+
+    async def get_all(self) -> dict[str,str]:
+        await self._ensure_fresh()
+        if self.error: # only the names looked up one by one are known
+            raise self.error
+        return self.names
+
+    async def get_name(self, user_id:str) -> str:
+        # Without a sweep the names come from users.info below
+        await self._ensure_fresh()
+        if user_id in self.names:
+            return self.names[user_id]
+
+        # Misses (users created after the sweep) are fetched once even if asked concurrently
+        if user_id in self._pending:
+            return await asyncio.shield(self._pending[user_id])
+        pending = self._pending[user_id] = asyncio.get_running_loop().create_future()
+        name = user_id
+        try:
+            data = await self.slack_client.call('users.info', user=user_id)
+            name = self.names[user_id] = self.display_name(data['user'])
+        except SlackApiError as s:
+            name = f'Failed fetching user name: error {s}'
+        finally:
+            self._pending.pop(user_id)
+            pending.set_result(name)
+        return name
+
+async def get_user_name(user_id:str = None) -> str:
     if not user_id:
         return 'No user provided'
     
-    try:
-        slack_client = Storage().slack_client
-        data = slack_client.users_info(user=user_id)
-        profile = data['user']['profile']
-        display_name = profile.get('display_name') or profile.get('real_name') or user_id
-        return display_name
-    except SlackApiError as s:
-        return f'Failed fetching user name: error {s}'
+    return await Storage().users.get_name(user_id)
     
-def get_ch_messages(channel_id:str = None, days:int = 1) -> list[Any]:    
+async def fetch_history(channel_id:str, oldest:float, latest:float | None = None) -> list[Any]:
+    """Downloads the channel messages in (oldest, latest), newest first"""
+    slack_user = Storage().slack_user
+    messages = []
+    async for message in slack_user.paginate(
+        'conversations.history', 'messages', max_items=MESSAGES_LIMIT,
+        channel=channel_id,
+        oldest=str(oldest),
+        latest=str(latest) if latest else None,
+        limit=200,
+        include_all_metadata=False,
+        inclusive=False
+    ):
+        messages.append(message)
+    return messages
+
+async def sync_channel(channel_id:str, oldest:float):
+    """Brings the local store up to date for the window starting at oldest.
+    Only the messages after the high-water mark, and before the stored window if asked for more days, are downloaded"""
+    store = Storage().messages
+    coverage = store.get_coverage(channel_id)
+    # A window that ends before the requested one is not extended, the sync starts again at oldest
+    if not coverage or coverage[1] < oldest:
+        older, newer = await fetch_history(channel_id, oldest), []
+        synced_from, synced_to = oldest, oldest
+    else:
+        older, newer = await asyncio.gather(
+            fetch_history(channel_id, oldest, coverage[0]) if oldest < coverage[0] else asyncio.sleep(0, []),
+            fetch_history(channel_id, coverage[1]))
+        synced_from, synced_to = min(oldest, coverage[0]), coverage[1]
+
+    # A cut fetch leaves a hole, the stored window then starts at the oldest message downloaded
+    if len(older) >= MESSAGES_LIMIT:
+        synced_from = min(float(m['ts']) for m in older)
+    if len(newer) >= MESSAGES_LIMIT:
+        synced_from = min(float(m['ts']) for m in newer)
+    messages = older + newer
+    synced_to = max([float(m['ts']) for m in messages] + [synced_to])
+    store.save(channel_id, messages, synced_from, synced_to)
+
+async def get_ch_messages(channel_id:str = None, days:int = 1) -> list[Any]:    
     now = datetime.now()
     past_days = now-timedelta(days=days)
-    timestamp = str(past_days.timestamp())
-    
-    messages = []
-    cursor = None
-    limit = 1000
+    timestamp = past_days.timestamp()
 
-    while len(messages)<limit:
-        try:
-            slack_user = Storage().slack_user
-            data = slack_user.conversations_history(
-                channel=channel_id,
-                oldest=timestamp,
-                cursor=cursor,
-                limit=min(limit-len(messages),1000),
-                include_all_metadata=False,
-                inclusive=False
-            )
-            messages.extend(data.get('messages',[]))
-            if data['response_metadata']:
-                cursor = data['response_metadata'].get('next_cursor',None)
-            else:
-                break
-        except SlackApiError as s:
-            messages.append(f'Failed to fetch messages: {s}')
-            return messages
+    try:
+        await sync_channel(channel_id, timestamp)
+    except SlackApiError as s:
+        return [f'Failed to fetch messages: {s}']
+    return Storage().messages.get_messages(channel_id, timestamp, MESSAGES_LIMIT)
+
+async def get_thread_replies(channel_id:str, parent:dict[str,Any]) -> list[Any]:
+    """Parent message plus its replies, served from the store while the thread latest_reply is unchanged
+    and for at most THREAD_TTL seconds, parents read from the store may carry an old latest_reply"""
+    store = Storage().messages
+    thread_ts = parent['ts']
+    latest_reply = parent.get('latest_reply', '')
+    replies = store.get_thread(channel_id, thread_ts, latest_reply, THREAD_TTL)
+    if replies is not None:
+        return replies
+
+    slack_user = Storage().slack_user
+    replies = []
+    async for reply in slack_user.paginate('conversations.replies', 'messages', channel=channel_id, ts=thread_ts, limit=200):
+        replies.append(reply)
+    store.save_thread(channel_id, thread_ts, latest_reply, replies)
+    return replies
+
+async def expand_threads(channel_id:str, messages:list[Any]) -> dict[str,list[Any]]:
+    """Fetches the replies of every threaded parent concurrently, the Slack rate limiter paces the requests"""
+    parents = [m for m in messages if isinstance(m, dict) and m.get('reply_count', 0) > 0]
+    results = await asyncio.gather(*[get_thread_replies(channel_id, m) for m in parents], return_exceptions=True)
+    threads = {}
+    for parent, replies in zip(parents, results):
+        if isinstance(replies, BaseException):
+            logger.debug(f'Failed to fetch replies of {parent["ts"]}: {replies}')
+            continue
+        threads[parent['ts']] = replies
+    return threads
+
+async def render_message(message:dict[str,Any], threads:dict[str,list[Any]] | None = None) -> str:
+    replies = (threads or {}).get(message.get('ts')) or [message]
+    parts=[
+        f'<@{await get_user_name(m.get('user'))}> : {m.get('text','[No text]')}' for m in replies
+    ]
+    return '\n'.join(parts)
+
+async def get_channel_messages(channel_id:str, days:int) -> list[Any]:
+    # The user directory sweep runs while the history is downloaded
+    messages, _ = await asyncio.gather(get_ch_messages(channel_id, days), Storage().users.get_all(), return_exceptions=True)
+    if isinstance(messages, BaseException):
+        return [f'Failed to fetch messages: {messages}']
     return messages
 
-def get_messages(channel_id:str = None, days:int = 1) -> list[Any]:
-    messages = get_ch_messages(channel_id, days)
+async def get_messages(channel_id:str = None, days:int = 1) -> list[Any]:
+    messages = await get_channel_messages(channel_id, days)
+    threads = await expand_threads(channel_id, messages)
     thread_replies = []
 
     for message in messages:
-        replies = [message]
-        parts=[
-            f'<@{get_user_name(m.get('user'))}> : {m.get('text','[No text]')}' for m in replies
-        ]
-        thread_replies.append('\n'.join(parts))
+        if isinstance(message, str):
+            thread_replies.append(message)
+            continue
+        thread_replies.append(await render_message(message, threads))
     
     return thread_replies
 
+def split_chunks(texts:list[str], max_tokens:int = CHUNK_TOKENS) -> list[list[str]]:
+    chunks = [[]]
+    tokens = 0
+    for text in texts:
+        size = estimate_tokens(text)
+        if chunks[-1] and tokens + size > max_tokens:
+            chunks.append([])
+            tokens = 0
+        chunks[-1].append(text)
+        tokens += size
+    return chunks
+
+async def reduce_summaries(summaries:list[str], limiter:asyncio.Semaphore) -> str:
+    """Merges partial summaries in token sized groups until a single one is left"""
+    llm_client = Storage().llm_client
+    async def merge(group:list[str]) -> str:
+        async with limiter:
+            return await llm_client.summarize_async(
+                f'combine the following partial summaries of a channel conversation into one summary: {group}.')
+    while len(summaries) > 1:
+        groups = split_chunks(summaries)
+        if len(groups) == 1:
+            break
+        summaries = list(await asyncio.gather(*[merge(group) for group in groups]))
+    return '\n'.join(summaries)
+
+async def summarize_day(channel_id:str, day:str, texts:list[str], limiter:asyncio.Semaphore) -> str:
+    """Map step, one summary per day reused by any later window that covers the same messages"""
+    store = Storage().messages
+    digest = hashlib.sha256('\n'.join(texts).encode('utf-8')).hexdigest()
+    cached = store.get_day_summary(channel_id, day, digest)
+    if cached:
+        return f'{day}: {cached}'
+
+    llm_client = Storage().llm_client
+    async def summarize_chunk(chunk:list[str]) -> str:
+        async with limiter:
+            return await llm_client.summarize_async(
+                f'summarize the following conversation from a channel on {day}: {chunk}.')
+    partial = await asyncio.gather(*[summarize_chunk(chunk) for chunk in split_chunks(texts)])
+    summary = await reduce_summaries(list(partial), limiter) if len(partial) > 1 else partial[0]
+    if not any(is_error(text) for text in partial + [summary]):
+        store.save_day_summary(channel_id, day, digest, summary)
+    return f'{day}: {summary}'
+
+async def summarize_messages(channel_id:str, days:int) -> str:
+    messages = await get_channel_messages(channel_id, days)
+    llm_client = Storage().llm_client
+    if messages and isinstance(messages[0], str):
+        return messages[0]
+
+    threads = await expand_threads(channel_id, messages)
+    by_day: dict[str,list[str]] = {}
+    for message in reversed(messages):
+        day = datetime.fromtimestamp(float(message['ts'])).strftime('%Y-%m-%d')
+        by_day.setdefault(day, []).append(await render_message(message, threads))
+    ch_messages = [text for texts in by_day.values() for text in texts]
+
+    # Small channels keep the single request
+    if sum(estimate_tokens(text) for text in ch_messages) <= CHUNK_TOKENS:
+        prompt = f'summarize the following conversation from a channel in less than 6 bullet points: {ch_messages}.'
+        return await llm_client.summarize_async(prompt)
+
+    limiter = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+    day_summaries = await asyncio.gather(*[summarize_day(channel_id, day, texts, limiter) for day, texts in by_day.items()])
+    partial = await reduce_summaries(list(day_summaries), limiter)
+    prompt = f'summarize the following daily summaries from a channel in less than 6 bullet points: {partial}.'
+    return await llm_client.summarize_async(prompt)
+
 ## TOOLS -----------------------------------------------------------------------
 
 @mcp.tool()
-def get_user_list() -> list[Any]:
+async def get_user_list() -> list[Any]:
     """Returns the user list from Slack workspace"""
     try:
-        slack_client = Storage().slack_client
-        data = slack_client.users_list()
+        names = await Storage().users.get_all()
     except SlackApiError as s:
         return [f'Users not found: error {s}']
     
-    users = []
-    for user in data['members']:
-        id = user['id']
-        user_name = get_user_name(id)
-        users.append((user_name, id))
-    return users
+    return [(user_name, id) for id, user_name in names.items()]
 
 @mcp.tool()
-def get_workspace_channels() -> list[Any]:
+async def get_workspace_channels() -> list[Any]:
     """Returns a list of the channels inside a workspace, id, name and purpose of the channel"""
     try:
         slack_client = Storage().slack_client
-        data = slack_client.conversations_list()
         ws_channels = []
-        for channel in data['channels']:
+        async for channel in slack_client.paginate('conversations.list', 'channels', limit=200):
             ch_id = channel['id']
             ch_name = channel['name']
             ch_purpose = channel['purpose']['value']
@@ -119,43 +321,43 @@ def get_workspace_channels() -> list[Any]:
         return [f'Error fetching ws channels: {s}']
 
 @mcp.tool()
-def get_user_channels(user_id:str = None) -> list[Any]:
+async def get_user_channels(user_id:str = None) -> list[Any]:
     """Returns the channel list from a particular user id (slack user id required)"""
     if not user_id:
         return ['No user provided']
     
     u_channels = []
-    cursor = None
-
-    while True:
-        try:
-            slack_client = Storage().slack_client
-            data = slack_client.users_conversations(
-                user=user_id,
-                types='public_channel',
-                cursor=cursor,
-                limit=100
-            )
-            if 'channels' in data and isinstance(data['channels'],list):
-                u_channels.extend(data['channels'] or [])
-            if not cursor:
-                break
-        except SlackApiError as s:
-            u_channels.append(f'Failed to fetch channels: {s}')
-            return u_channels
+    try:
+        slack_client = Storage().slack_client
+        async for channel in slack_client.paginate(
+            'users.conversations', 'channels',
+            user=user_id,
+            types='public_channel',
+            limit=100
+        ):
+            u_channels.append((channel['id'],channel['name']))
+    except SlackApiError as s:
+        u_channels.append(f'Failed to fetch channels: {s}')
     
-    return [(channel['id'],channel['name']) for channel in u_channels]
+    return u_channels
 
 @mcp.tool() ##TODO: Convert into a resource or prompt
-def summarize_channel(channel_id:str = None, days:int = 1) -> str:
+async def summarize_channel(channel_id:str = None, days:int = 1) -> str:
     """Given a channel ID (slack channel IS required) and the days, summarizes the channel messages from the past days"""
     if not channel_id:
         return 'No Channel id provided'
-    ch_messages = get_messages(channel_id=channel_id, days=days)
-    prompt = f'summarize the following conversation from a channel in less than 6 bullet points: {ch_messages}.'
-    llm_client = Storage().llm_client
-    summary_text = llm_client.summarize(prompt)
-    return summary_text
+    return await summarize_messages(channel_id, days)
+
+@mcp.tool()
+async def summarize_channels(channel_ids:list[str], days:int = 1) -> dict[str,str]:
+    """Given a list of channel IDs (slack channel ids required) and the days, summarizes each channel messages from the past days"""
+    if not channel_ids:
+        return {'error': 'No Channel ids provided'}
+    summaries = await asyncio.gather(*[summarize_messages(ch_id, days) for ch_id in channel_ids], return_exceptions=True)
+    return {
+        ch_id: summary if isinstance(summary, str) else f'Failed to summarize channel: {summary}'
+        for ch_id, summary in zip(channel_ids, summaries)
+    }
 
 ## -----------------------------------------------------------------------------
 
@@ -1,25 +1,132 @@
-from typing import Any
+from typing import Any, AsyncIterator, Awaitable, Callable
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+import asyncio, time
 import httpx
+from pydantic import BaseModel
 from mcp.server.fastmcp import FastMCP
+from modules.grid_cache import GridCache
 
-mcp = FastMCP("weather")
+try:
+    import h2 # noqa: F401 httpx only negotiates HTTP/2 when h2 is installed
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
 
 NWS_API_BASE = "https://api.weather.gov"
 USER_AGENT = "weather-app/1.0"
+HTTP_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60)
+HTTP_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+CACHE_ENTRIES = 512 # responses kept in memory, least recently used dropped first
+GRID_CACHE_PATH = "nws_grid.db"
+GRID_TTL = 30 * 86400 # the point to grid mapping only changes when NWS redraws its grids
+GRID_NEGATIVE_TTL = 86400 # points outside the NWS coverage
+POINT_FIELDS = ("forecast", "forecastHourly", "gridId", "gridX", "gridY")
+BATCH_CONCURRENCY = 5 # NWS requests in flight per batch tool call
+MAX_BATCH = 50 # items fetched per batch tool call, the rest get an error item
+
+# One client for the life of the server, connections are kept alive between tool calls
+_client: httpx.AsyncClient | None = None
+_cache: OrderedDict[str, tuple[float, dict[str, Any]]] = OrderedDict()
+grid_cache = GridCache(GRID_CACHE_PATH, GRID_TTL, GRID_NEGATIVE_TTL)
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=HTTP2,
+            limits=HTTP_LIMITS,
+            timeout=HTTP_TIMEOUT,
+            headers={
+                "User-Agent": USER_AGENT,
+                "Accept": "application/geo+json"
+            })
+    return _client
+
+@asynccontextmanager
+async def lifespan(server: FastMCP) -> AsyncIterator[None]:
+    try:
+        yield
+    finally:
+        if _client is not None:
+            await _client.aclose()
+
+mcp = FastMCP("weather", lifespan=lifespan)
+
+class Location(BaseModel):
+    latitude: float
+    longitude: float
+
+def cache_ttl(headers: httpx.Headers) -> float:
+    """Seconds the response can be reused, from Cache-Control max-age or Expires (0 if not cacheable)"""
+    cache_control = headers.get("Cache-Control", "").lower()
+    directives = dict(
+        (part.split("=", 1) + [""])[:2] for part in (d.strip() for d in cache_control.split(",")) if part)
+    if "no-store" in directives or "no-cache" in directives or "private" in directives:
+        return 0
+    for name in ("s-maxage", "max-age"):
+        if directives.get(name, "").isdigit():
+            return max(0, int(directives[name]) - int(headers.get("Age", "0") or 0))
+    if "Expires" in headers:
+        try:
+            expires = parsedate_to_datetime(headers["Expires"])
+            date = parsedate_to_datetime(headers["Date"]) if "Date" in headers else None
+            now = date.timestamp() if date else time.time()
+            return max(0, expires.timestamp() - now)
+        except (TypeError, ValueError):
+            return 0
+    return 0
+
+async def nws_request(url: str) -> tuple[int, dict[str, Any] | None]:
+    """Make a request to the NWS API, returns the HTTP status (0 if the request failed) and the data.
+    Responses are served from the cache while their Cache-Control/Expires lifetime lasts."""
+    cached = _cache.get(url)
+    if cached and cached[0] > time.monotonic():
+        _cache.move_to_end(url)
+        return 200, cached[1]
+    _cache.pop(url, None)
+
+    try:
+        response = await get_client().get(url)
+        response.raise_for_status()
+        data = response.json()
+    except httpx.HTTPStatusError as e:
+        return e.response.status_code, None
+    except Exception:
+        return 0, None
+
+    ttl = cache_ttl(response.headers)
+    if ttl:
+        _cache[url] = (time.monotonic() + ttl, data)
+        while len(_cache) > CACHE_ENTRIES:
+            _cache.popitem(last=False)
+    return 200, data
 
 async def make_nws_request(url: str) -> dict[str, Any] | None:
     """Make a request to the NWS API with proper error handling."""
-    headers = {
-        "User-Agent": USER_AGENT,
-        "Accept": "application/geo+json"
-    }
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(url, headers=headers, timeout=30.0)
-            response.raise_for_status()
-            return response.json()
-        except Exception:
-            return None
+    _, data = await nws_request(url)
+    return data
+
+async def get_point(latitude: float, longitude: float) -> dict[str, Any] | None:
+    """Forecast URLs and gridpoint for a location, from the grid cache when possible.
+    Only a 404 (point outside the NWS coverage) is cached as a miss, other errors are retried next time."""
+    found, point = grid_cache.get(latitude, longitude)
+    if found:
+        return point
+
+    lat, lon = grid_cache.key(latitude, longitude)
+    status, points_data = await nws_request(f"{NWS_API_BASE}/points/{lat},{lon}")
+    if not points_data:
+        if status == 404:
+            grid_cache.set(latitude, longitude, None)
+        return None
+
+    properties = points_data.get("properties") or {}
+    point = {field: properties.get(field) for field in POINT_FIELDS}
+    if point["forecast"]:
+        grid_cache.set(latitude, longitude, point)
+    return point
 
 def format_alert(feature: dict) -> str:
     """Format an alert feature into a readable string."""
@@ -32,46 +139,33 @@ def format_alert(feature: dict) -> str:
             Instructions: {props.get('instruction', 'No specific instructions provided')}
             """
 
-@mcp.tool()
-async def get_alerts(state: str) -> str:
-    """Get weather alerts for a US state.
+OVER_LIMIT = {"ok": False, "error": f"Not fetched, a batch call takes at most {MAX_BATCH} items. Send the rest in another call."}
 
-    Args:
-        state: Two-letter US state code (e.g. CA, NY)
-    """
+class WeatherError(Exception):
+    """NWS data not available, the message is returned to the caller"""
+
+async def fetch_alerts(state: str) -> list[str]:
     url = f"{NWS_API_BASE}/alerts/active/area/{state}"
     data = await make_nws_request(url)
 
     if not data or "features" not in data:
-        return "Unable to fetch alerts or no alerts found."
+        raise WeatherError("Unable to fetch alerts or no alerts found.")
 
-    if not data["features"]:
-        return "No active alerts for this state."
-
-    alerts = [format_alert(feature) for feature in data["features"]]
-    return "\n---\n".join(alerts)
+    return [format_alert(feature) for feature in data["features"]]
 
-@mcp.tool()
-async def get_forecast(latitude: float, longitude: float) -> str:
-    """Get weather forecast for a location.
-
-    Args:
-        latitude: Latitude of the location
-        longitude: Longitude of the location
-    """
+async def fetch_forecast(latitude: float, longitude: float) -> list[str]:
     # First get the forecast grid endpoint
-    points_url = f"{NWS_API_BASE}/points/{latitude},{longitude}"
-    points_data = await make_nws_request(points_url)
+    point = await get_point(latitude, longitude)
 
-    if not points_data:
-        return "Unable to fetch forecast data for this location."
+    if not point or not point["forecast"]:
+        raise WeatherError("Unable to fetch forecast data for this location.")
 
-    # Get the forecast URL from the points response
-    forecast_url = points_data["properties"]["forecast"]
-    forecast_data = await make_nws_request(forecast_url)
+    status, forecast_data = await nws_request(point["forecast"])
 
     if not forecast_data:
-        return "Unable to fetch detailed forecast."
+        if status == 404: # the grid moved, resolve the point again next time
+            grid_cache.delete(latitude, longitude)
+        raise WeatherError("Unable to fetch detailed forecast.")
 
     # Format the periods into a readable forecast
     periods = forecast_data["properties"]["periods"]
@@ -84,9 +178,84 @@ async def get_forecast(latitude: float, longitude: float) -> str:
                     Forecast: {period['detailedForecast']}
                     """
         forecasts.append(forecast)
+    return forecasts
+
+async def run_batch(keys: list[Any], fetch: Callable[[Any], Awaitable[list[str]]]) -> dict[Any, dict[str, Any]]:
+    """Fetches every distinct key concurrently (at most BATCH_CONCURRENCY at a time),
+    a failed item only reports its own error"""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(key):
+        async with semaphore:
+            try:
+                return {"ok": True, "result": await fetch(key)}
+            except WeatherError as e:
+                return {"ok": False, "error": str(e)}
+            except Exception as e:
+                return {"ok": False, "error": f"Unexpected error: {e}"}
+
+    unique = list(dict.fromkeys(keys))
+    results = await asyncio.gather(*(run(key) for key in unique))
+    return dict(zip(unique, results))
+
+@mcp.tool()
+async def get_alerts(state: str) -> str:
+    """Get weather alerts for a US state.
+
+    Args:
+        state: Two-letter US state code (e.g. CA, NY)
+    """
+    try:
+        alerts = await fetch_alerts(state)
+    except WeatherError as e:
+        return str(e)
+
+    if not alerts:
+        return "No active alerts for this state."
+
+    return "\n---\n".join(alerts)
+
+@mcp.tool()
+async def get_forecast(latitude: float, longitude: float) -> str:
+    """Get weather forecast for a location.
+
+    Args:
+        latitude: Latitude of the location
+        longitude: Longitude of the location
+    """
+    try:
+        forecasts = await fetch_forecast(latitude, longitude)
+    except WeatherError as e:
+        return str(e)
 
     return "\n---\n".join(forecasts)
 
+@mcp.tool()
+async def get_alerts_batch(states: list[str]) -> list[dict[str, Any]]:
+    """Get weather alerts for several US states in one call.
+    Returns one item per state with ok, and the alerts or the error. At most 50 states are fetched per call.
+
+    Args:
+        states: Two-letter US state codes (e.g. ["CA", "NY"])
+    """
+    states = [state.strip().upper() for state in states]
+    results = await run_batch(states[:MAX_BATCH], fetch_alerts)
+    return [{"state": state, **results[state]} for state in states[:MAX_BATCH]] + [
+        {"state": state, **OVER_LIMIT} for state in states[MAX_BATCH:]]
+
+@mcp.tool()
+async def get_forecast_batch(locations: list[Location]) -> list[dict[str, Any]]:
+    """Get weather forecasts for several locations in one call.
+    Returns one item per location with ok, and the forecast periods or the error. At most 50 locations are fetched per call.
+
+    Args:
+        locations: Latitude/longitude pairs (e.g. [{"latitude": 38.9, "longitude": -77.0}])
+    """
+    keys = [grid_cache.key(location.latitude, location.longitude) for location in locations]
+    results = await run_batch(keys[:MAX_BATCH], lambda key: fetch_forecast(*key))
+    return [{"latitude": lat, "longitude": lon, **results[(lat, lon)]} for lat, lon in keys[:MAX_BATCH]] + [
+        {"latitude": lat, "longitude": lon, **OVER_LIMIT} for lat, lon in keys[MAX_BATCH:]]
+
 if __name__ == "__main__":
     # Initialize and run the server
     mcp.run(transport='stdio')
\ No newline at end of file
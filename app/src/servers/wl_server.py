@@ -1,11 +1,24 @@
 from typing import Any
+from collections import OrderedDict
+import threading, uuid, logging
+from datetime import datetime
 from modules.config import Settings
-from modules.oci_client import Client
+from modules.oci_client import Client, FILTER_DEFAULT
+from modules.cache import ResponseCache, make_key, normalize
+from modules.filter_rules import extract_filter
 from modules.db import DataBase
-from mcp.server.fastmcp import FastMCP
+from modules.vector_index import VectorIndex
+from mcp.server.fastmcp import FastMCP, Context
 from dotenv import load_dotenv
 
 mcp = FastMCP("W/L DB")
+logger = logging.getLogger(name=f'WL.{__name__}')
+
+RESULTS_MAX_BYTES = 64 * 1024 * 1024 # search results (ids, names and loaded content) kept in memory
+FILTER_CACHE_SIZE = 512 # LLM filter extractions kept by normalized query
+FILTER_CACHE_TTL = 86400
+UNINDEXED_DOCS = 16 # results not embedded yet sent next to the chunks, as a bounded extract each
+UNINDEXED_DOC_CHARS = 2000
 
 class Storage:
     _instance = None
@@ -19,17 +32,149 @@ class Storage:
     def __init__(self):
         if not Storage._initialized:
             load_dotenv()
-            self.merged_data = ''
             self.settings = Settings("C:/Users/Cristopher Hdz/Desktop/Test/mcp_step/app/src/config/mcp.yaml")
             self.db = DataBase(self.settings)
+            self.schema_error: str | None = None
+            self._schema_checked = False
             self.llm_client = Client(self.settings)
+            self.facets = None
+            self.facets_version = None
+            self.results = ResultStore()
+            rag = self.settings.rag or {}
+            self.index = VectorIndex(rag.get('index_path', 'wl_index.db'))
+            self.top_k = rag.get('top_k', 8)
+            self.index_version = None
+            self._index_lock = threading.Lock()
+            self._index_thread: threading.Thread | None = None
+            self.filter_cache = ResponseCache(memory_entries=FILTER_CACHE_SIZE, ttl=FILTER_CACHE_TTL)
             Storage._initialized = True
-    
-    def storage_data(self,data:str):
-        self.merged_data = data
-    
-    def get_storage_data(self) -> str:
-        return self.merged_data
+            self.start_index_sync()
+
+    def check_schema(self) -> str | None:
+        """Error to report while WL_Calls lacks the migrated columns, None when it has them.
+        The DDL runs only from python -m modules.db --migrate, the server just checks its result"""
+        if self._schema_checked:
+            return self.schema_error
+        try:
+            missing = self.db.missing_columns()
+        except Exception as e:
+            # Not remembered, the DB may be reachable on the next call
+            logger.error(f'Schema check failed: {e}')
+            return f'W/L database unavailable: {e}'
+        if missing:
+            self.schema_error = (f"WL_Calls is missing the columns {', '.join(missing)}, "
+                                 "run python -m modules.db --migrate from app/src/servers and restart the server")
+            logger.error(self.schema_error)
+        self._schema_checked = True
+        return self.schema_error
+
+    def get_facets(self) -> dict[str,Any]:
+        """Filter facets computed in the DB, recomputed only when WL_Calls changed"""
+        version = self.db.data_version()
+        if self.facets is None or version != self.facets_version:
+            self.facets = self.db.get_facets()
+            self.facets_version = version
+        return self.facets
+
+    async def get_llm_filter(self, query:str) -> list:
+        key = make_key('filter', normalize(query).lower())
+        cached = self.filter_cache.get(key)
+        if cached:
+            return cached
+        filter = await self.llm_client.filter_files_async(query)
+        if filter != FILTER_DEFAULT: # unparsed answers are not cached
+            self.filter_cache.set(key, filter)
+        return filter
+
+    def start_index_sync(self):
+        """Runs sync_index in a background thread so no tool call waits for the corpus to be embedded"""
+        if self.check_schema() or (self._index_thread and self._index_thread.is_alive()):
+            return
+        self._index_thread = threading.Thread(target=self.sync_index, name='wl_index_sync', daemon=True)
+        self._index_thread.start()
+
+    def sync_index(self, updated_ids:list[int] | None = None):
+        """Embeds the call reports added since the last sync and the updated ones.
+        Ingestion code can pass it as the on_commit of DataBase.ingest / update_db_records"""
+        try:
+            self._sync_index(updated_ids or [])
+        except Exception as e:
+            logger.debug(f'Index sync failed: {e}')
+
+    def _sync_index(self, updated_ids:list[int]):
+        with self._index_lock:
+            self._reindex(updated_ids)
+            version = self.db.data_version()
+            if version == self.index_version:
+                return
+            # Rows updated in place since the stored mark, by another process or while the server was down.
+            # Without a mark every updated row is embedded again, unless the index is still empty
+            stored = self.index.get_state('last_updated')
+            last_updated = datetime.fromisoformat(stored) if stored else None
+            if version[2] is not None and version[2] != last_updated:
+                changed = self.db.updated_since(last_updated) if len(self.index) else []
+                changed = [id for id in changed if id not in set(updated_ids)] # embedded just above
+                if self._reindex(changed):
+                    self.index.set_state('last_updated', version[2].isoformat())
+            if self.index.sync(self.db.iter_content(self.index.synced_id), self.llm_client.embed, new_rows=True):
+                self.index_version = version
+
+    def _reindex(self, doc_ids:list[int]) -> bool:
+        if not doc_ids:
+            return True
+        self.index.remove(doc_ids)
+        return self.index.sync([list(self.db.content_by_id(doc_ids).items())], self.llm_client.embed)
+
+class SearchResult:
+    def __init__(self, ids:list[int], names:list[str]):
+        self.ids = ids
+        self.names = names
+        self.content: str | None = None # loaded on the first analysis
+
+    def size(self) -> int:
+        return len(self.content or '') + sum(len(name) for name in self.names) + 8 * len(self.ids)
+
+class ResultStore:
+    """Search results by handle, each client session remembers its last one.
+    Least recently used results are dropped once the total size passes max_bytes"""
+    def __init__(self, max_bytes:int = RESULTS_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.results: OrderedDict[str,SearchResult] = OrderedDict()
+        self.latest: dict[Any,str] = {}
+        self.total_bytes = 0
+
+    def add(self, session_key:Any, ids:list[int], names:list[str]) -> str:
+        handle = uuid.uuid4().hex[:8]
+        result = SearchResult(ids, names)
+        self.results[handle] = result
+        self.total_bytes += result.size()
+        self.latest[session_key] = handle
+        self._evict(keep=handle)
+        return handle
+
+    def get(self, handle:str | None, session_key:Any = None) -> SearchResult | None:
+        handle = handle or self.latest.get(session_key)
+        if handle not in self.results:
+            return None
+        self.results.move_to_end(handle)
+        return self.results[handle]
+
+    def load_content(self, result:SearchResult, loader) -> str:
+        if result.content is None:
+            before = result.size()
+            result.content = '\n'.join(loader(result.ids))
+            self.total_bytes += result.size() - before
+            self._evict(keep=next(h for h, r in self.results.items() if r is result))
+        return result.content
+
+    def _evict(self, keep:str):
+        while self.total_bytes > self.max_bytes and len(self.results) > 1:
+            handle, result = next(iter(self.results.items()))
+            if handle == keep:
+                self.results.move_to_end(handle)
+                continue
+            self.results.pop(handle)
+            self.total_bytes -= result.size()
 
 def get_db_response(
         name_list,
@@ -39,69 +184,80 @@ def get_db_response(
         customer=None,
         product=None
     ):
-    db_query = Storage().db.build_query(name_list,year,type,region,customer,product)
-    db_response = Storage().db.sort_files(db_query)
-    lists = [list(group) for group in zip(*db_response)]
+    db_query, binds = Storage().db.build_query(name_list,year,type,region,customer,product)
+    lists = Storage().db.fetch_columns(db_query, binds)
     return lists
 
-def merge_md(file_list):
-    info_pack = ''
-    for data in file_list:
-        info_pack = info_pack + '\n' + data
-    return info_pack
-
-def manage_filter(year,type,region,customer,product):
-    data = get_db_response(['t.metadata.file_name','t.content'],year,type,region,customer,product)
+def manage_filter(year,type,region,customer,product,session_key=None):
+    data = get_db_response(['t.id','t.metadata.file_name'],year,type,region,customer,product)
     if not data:
-        Storage().storage_data('Not data found')
-        return ['No files found with that filter']
+        return {'handle': None, 'files': ['No files found with that filter']}
     else:
-        merged_data = merge_md(data[1])
-        Storage().storage_data(merged_data)
-        return data[0]
+        handle = Storage().results.add(session_key, data[0], data[1])
+        return {'handle': handle, 'files': data[1]}
     
-def get_client_filter(prompt:str):
-    r_dict = Storage().llm_client.filter_files(prompt)
+async def get_client_filter(prompt:str, session_key=None):
+    storage = Storage()
+    r_dict, ambiguous = extract_filter(prompt, storage.get_facets())
+    if ambiguous:
+        r_dict = await storage.get_llm_filter(prompt)
     year_p = r_dict[0]
     type_p = r_dict[1]
     region_p = r_dict[2]
     customer_p = r_dict[3]
     product_p = r_dict[4]
-    lists = manage_filter(year_p,type_p,region_p,customer_p,product_p)
+    lists = manage_filter(year_p,type_p,region_p,customer_p,product_p,session_key)
     return lists
 
 ## TOOLS -----------------------------------------------------------------------
 
 @mcp.tool()
-def search_documents_by_query(query:str = '') -> list[Any]:
-    """Returns the available call report documents using the user query to build a DB request"""
-    return get_client_filter(query)
+async def search_documents_by_query(ctx:Context, query:str = '') -> dict[str,Any]:
+    """Returns the available call report documents using the user query to build a DB request,
+    plus a result handle to analyse those documents later"""
+    error = Storage().check_schema()
+    if error:
+        return {'handle': None, 'files': [error]}
+    return await get_client_filter(query, id(ctx.session))
 
 @mcp.tool()
-def get_available_filters() -> list[Any]:
-    """Gives the user information about the filters that are available to search the call report documents"""
-    responses = get_db_response(
-        ['t.metadata.report_date','t.metadata.type','t.metadata.regions[0].region']
-    )
-    years = [int(date[:4]) for date in responses[0]]
-    years.insert(0,2010)
-    unique_years = sorted(set(years))
-
-    responses[1].insert(0,"")
-    unique_type = sorted(set(responses[1]))
-
-    responses[2].insert(0,"")
-    unique_region = sorted(set(responses[2]))
-
-    filters = [unique_years,unique_type,unique_region]
-
-    return filters
+def get_available_filters() -> dict[str,Any]:
+    """Gives the user information about the filters that are available to search the call report documents,
+    each filter value comes with the number of documents that have it"""
+    storage = Storage()
+    error = storage.check_schema()
+    if error:
+        return {'error': error}
+    return storage.get_facets()
 
 @mcp.tool()
-def analyse_documents(query:str) -> str:
-    """Based on the content of the call report documents filtered, answers the user query"""
-    prompt = query + f' given the data in {Storage().get_storage_data()}'
-    analysis = Storage().llm_client.provide_analysis(prompt)
+async def analyse_documents(ctx:Context, query:str, handle:str = '') -> str:
+    """Based on the content of the call report documents filtered, answers the user query.
+    Uses the result handle from the search, or the last search of this session if not given"""
+    storage = Storage()
+    error = storage.check_schema()
+    if error:
+        return error
+    result = storage.results.get(handle, id(ctx.session))
+    if result is None:
+        return 'Not data found, search the documents first'
+    # New documents are embedded in the background, while none of the results is indexed the full content is sent
+    storage.start_index_sync()
+    # Only the chunks closest to the query, so the prompt size does not grow with the filter
+    query_vector = await storage.llm_client.embed_async([query], 'SEARCH_QUERY')
+    chunks = storage.index.search(query_vector[0], storage.top_k, result.ids) if query_vector else []
+    if chunks:
+        # Results the sync has not reached yet would not be seen through the chunks alone
+        indexed = storage.index.indexed(result.ids)
+        unindexed = [id for id in result.ids if id not in indexed][:UNINDEXED_DOCS]
+        extracts = [text[:UNINDEXED_DOC_CHARS] for text in storage.db.fetch_content(unindexed)] if unindexed else []
+        content = '\n'.join(chunks + extracts)
+    else:
+        content = storage.results.load_content(result, storage.db.fetch_content)
+    prompt = query + f' given the data in {content}'
+    # Each client session keeps its own analysis history, with the question only and not the documents
+    analysis = await storage.llm_client.provide_analysis_async(
+        prompt, session=f'wl-{id(ctx.session)}', memory_prompt=query)
     return analysis
 
 ## -----------------------------------------------------------------------------